@@ -0,0 +1,174 @@
+import os, json, time, socket, shutil, tempfile, multiprocessing, importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# best pool settings per machine, written by the calibration runs and read by split_predict and densitymap
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".cache", "carolina_redroot")
+READY_TIMEOUT = 600 # seconds the warm-up waits for every worker to load its model
+
+
+def config_path():
+    """Tuning file of this machine (one per hostname)."""
+    return os.path.join(CONFIG_DIR, f"autotune_{socket.gethostname()}.json")
+
+
+def load(section):
+    """
+    Tuned settings of this machine for one pool ("predict" or "density")
+    return: dict of settings, or None if the machine was not tuned or its core count changed since
+    """
+    path = config_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        tuned = json.load(f)
+    if tuned.get("cpus") != os.cpu_count():
+        return None
+    return tuned.get(section)
+
+
+def save(section, settings):
+    """Store the tuned settings of one pool, keeping the other sections of the file."""
+    path = config_path()
+    tuned = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+    tuned.update({"host": socket.gethostname(), "cpus": os.cpu_count(), section: settings})
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(tuned, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def tuned_setting(section, key, default=None):
+    """One tuned setting of a pool ("workers", "threads", ...), default when the machine was not tuned."""
+    settings = load(section)
+    return settings.get(key, default) if settings is not None else default
+
+
+def worker_counts(cpus):
+    """Candidate worker counts: powers of two up to the core count, and the core count itself."""
+    counts, w = [], 1
+    while w < cpus:
+        counts.append(w)
+        w *= 2
+    return counts + [cpus]
+
+
+def thread_counts(cpus, workers):
+    """Candidate threads per worker: cores / workers (no oversubscription) or half of it (room for decode and writes)."""
+    threads = max(1, cpus // workers)
+    return sorted({threads, max(1, threads // 2)})
+
+
+def _ready(barrier, timeout):
+    """Warm-up task: returns once every worker runs one, i.e. every worker process exists and has loaded its model."""
+    barrier.wait(timeout)
+
+
+def time_predict(image_names, parent_directory, image_folder_dir, weight_path, workers, threads, batchsize,
+                 img_dim=640, iou_thresh=0.5, conf_thresh=0.35, backend="torch", int8=False, images_per_task=4):
+    """
+    Throughput of one split_predict pool configuration on a sample of images (model loading excluded)
+    return: images per second
+    """
+    import split_predict
+    output_dir = tempfile.mkdtemp(prefix="autotune_")
+    try:
+        process = partial(split_predict.predictImageBatch, parent_directory=parent_directory, image_folder_dir=image_folder_dir,
+                          weight_path=weight_path, output_dir=output_dir, img_dim=img_dim, iou_thresh=iou_thresh,
+                          conf_thresh=conf_thresh, batchsize=batchsize, save_overlay=False, backend=backend, int8=int8)
+        with ProcessPoolExecutor(max_workers=workers, initializer=split_predict.init_worker,
+                                 initargs=(os.path.join(parent_directory, weight_path), backend, threads, int8)) as executor:
+            # the initializer loads the model before a worker takes its first task, and a task blocking on a barrier
+            # of all workers makes the pool start every process, so the timing below excludes model loading
+            with multiprocessing.Manager() as manager:
+                barrier = manager.Barrier(workers)
+                list(executor.map(partial(_ready, barrier), [READY_TIMEOUT] * workers))
+            start = time.perf_counter()
+            list(executor.map(process, split_predict.chunk_list(image_names, images_per_task)))
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return len(image_names) / elapsed
+
+
+def tune_predict(image_names, parent_directory, image_folder_dir, weight_path, sample_images=8, backend="torch", int8=False,
+                 batchsizes=(4, 8, 16), **kwargs):
+    """
+    Search the pool configuration of split_predict on a few images, one setting at a time, and keep the fastest
+    Worker counts are timed first (cores / workers threads each, the middle batchsize), then the thread counts of the
+    best worker count, then the batchsizes, instead of every combination.
+    Each configuration gets at least one task per worker, so large pools are not judged on an idle tail.
+    param sample_images: images timed per configuration (raised to 4 images per worker)
+    return: best settings dict (workers, threads, batchsize, images_per_s)
+    """
+    cpus, speeds = os.cpu_count(), {}
+
+    def speed(candidate):
+        if candidate not in speeds:
+            workers, threads, batchsize = candidate
+            count = max(sample_images, 4 * workers)
+            sample = (image_names * (count // max(len(image_names), 1) + 1))[:count]
+            speeds[candidate] = time_predict(sample, parent_directory, image_folder_dir, weight_path, workers, threads, batchsize,
+                                             backend=backend, int8=int8, **kwargs)
+            print(f"workers {workers:>3}, threads {threads:>3}, batchsize {batchsize:>3}: {speeds[candidate]:.2f} images/s")
+        return speeds[candidate]
+
+    workers, threads, batchsize = max(((w, max(1, cpus // w), batchsizes[len(batchsizes) // 2]) for w in worker_counts(cpus)), key=speed)
+    workers, threads, batchsize = max(((workers, t, batchsize) for t in thread_counts(cpus, workers)), key=speed)
+    workers, threads, batchsize = max(((workers, threads, b) for b in batchsizes), key=speed)
+    best = {"workers": workers, "threads": threads, "batchsize": batchsize, "images_per_s": round(speeds[workers, threads, batchsize], 3)}
+    save("predict", best)
+    return best
+
+
+def tune_density(config):
+    """
+    Search the densitymap georef pool on a flight, one setting at a time, and keep the fastest
+    Worker counts are timed first (cores / workers threads each), then the thread counts of the best worker count.
+    Threads are only searched with threadpoolctl installed, which densitymap needs to limit them.
+    param config: densitymap.DensityConfig of a flight
+    return: best settings dict (workers, threads, images_per_s)
+    """
+    import densitymap
+    context = densitymap.FlightContext(config)
+    context.metadata # read once, outside the timings
+    cpus, speeds, configured = os.cpu_count(), {}, (config.workers, config.threads_per_worker)
+    limit_threads = importlib.util.find_spec("threadpoolctl") is not None
+
+    def speed(candidate):
+        if candidate not in speeds:
+            config.workers, config.threads_per_worker = candidate
+            start = time.perf_counter()
+            densitymap.georef_flight(context)
+            speeds[candidate] = len(context.img_list) / (time.perf_counter() - start)
+            print(f"workers {candidate[0]:>3}, threads {str(candidate[1]):>4}: {speeds[candidate]:.2f} images/s")
+        return speeds[candidate]
+
+    try:
+        workers, threads = max(((w, max(1, cpus // w) if limit_threads else None) for w in worker_counts(cpus)), key=speed)
+        if limit_threads:
+            workers, threads = max(((workers, t) for t in thread_counts(cpus, workers)), key=speed)
+    finally:
+        config.workers, config.threads_per_worker = configured
+    best = {"workers": workers, "threads": threads, "images_per_s": round(speeds[workers, threads], 3)}
+    save("density", best)
+    return best
+
+
+if __name__ == "__main__":
+    import densitymap
+
+    parent_directory = "./"
+    image_folder_dir = "DJI_202508081433_021_PineIslandbog5H3m5x3photo/"
+    weight_path = "best.pt"
+
+    image_dir = os.path.join(parent_directory, image_folder_dir)
+    image_names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(".jpg"))
+    print("Tuning split_predict pool...")
+    print(f"best: {tune_predict(image_names, parent_directory, image_folder_dir, weight_path)}\n")
+    print("Tuning densitymap pool...")
+    print(f"best: {tune_density(densitymap.DensityConfig())}")
+    print(f"Saved to {config_path()}")
@@ -0,0 +1,230 @@
+import os, io, json, time, shutil, socket, tempfile, tracemalloc, numpy as np, cv2, pyexiv2
+from contextlib import redirect_stdout
+import nms_module, nms_benchmark, georef2, shift_vector_module, densitymap, flight_metadata
+
+# reproducible workload: a synthetic flight (DJI XMP/EXIF tags, OBB labels) and a stub detector, no GPU or network needed
+pyexiv2.registerNs("http://www.dji.com/drone-dji/1.0/", "drone-dji")
+
+IMAGE_WIDTH, IMAGE_HEIGHT = 5280, 3956 # size recorded in EXIF, the JPEGs themselves are tiny
+SCALES = {
+    "small": {"images": 25, "density": 20, "nms_boxes": 2_000, "tiling_images": 2, "side_length": 1.0},
+    "medium": {"images": 100, "density": 60, "nms_boxes": 20_000, "tiling_images": 4, "side_length": 0.5},
+    "large": {"images": 400, "density": 150, "nms_boxes": 100_000, "tiling_images": 8, "side_length": 0.25},
+}
+REGRESSION_TOLERANCE = 0.10 # throughput drop flagged when comparing against a baseline
+
+
+def write_image(path, lat, lon, yaw, pitch, altitude):
+    """Write a small JPEG carrying the drone-dji XMP tags and EXIF dimensions read by flight_metadata."""
+    cv2.imwrite(path, np.zeros((8, 8, 3), np.uint8))
+    img = pyexiv2.Image(path)
+    try:
+        img.modify_xmp({"Xmp.drone-dji.GpsLatitude": f"{lat:.9f}", "Xmp.drone-dji.GpsLongitude": f"{lon:.9f}",
+                        "Xmp.drone-dji.FlightYawDegree": f"{yaw:.2f}", "Xmp.drone-dji.GimbalPitchDegree": f"{pitch:.1f}",
+                        "Xmp.drone-dji.RelativeAltitude": f"+{altitude:.3f}"})
+        img.modify_exif({"Exif.Photo.PixelXDimension": str(IMAGE_WIDTH), "Exif.Photo.PixelYDimension": str(IMAGE_HEIGHT)})
+    finally:
+        img.close()
+
+
+def make_flight(root, n_images, density, seed=0):
+    """
+    Generate a synthetic flight: a lawnmower grid of waypoint images, one OBB label file per image and 4 corner images
+    param density: mean number of detections per image (every 7th image has none)
+    return: dict with img_dir, label_dir and corner_dir (corner_dir relative to root)
+    """
+    rng = np.random.default_rng(seed)
+    img_dir, label_dir, corner_dir = os.path.join(root, "flight"), os.path.join(root, "labels"), "corners"
+    for path in (img_dir, label_dir, os.path.join(root, corner_dir)):
+        os.makedirs(path, exist_ok=True)
+
+    cols = int(np.ceil(np.sqrt(n_images)))
+    for i in range(n_images):
+        row, col = divmod(i, cols)
+        name = f"DJI_20250808143604_{i + 1:04d}_D_Waypoint{i + 1}"
+        write_image(os.path.join(img_dir, name + ".JPG"), 41.9 + row * 2e-5, -70.7 + col * 3e-5,
+                    12.3 + rng.normal(0, 1), -60 + rng.normal(0, 2), 5 + rng.normal(0, 0.2))
+        count = 0 if i % 7 == 3 else rng.poisson(density)
+        centers = rng.uniform(0.02, 0.98, (count, 2))
+        half = rng.uniform(0.003, 0.01, (count, 1))
+        corners = centers[:, None, :] + half[:, None, :] * np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+        with open(os.path.join(label_dir, name + ".txt"), "w") as f:
+            for box in corners.astype(np.float32):
+                f.write("0 " + " ".join(f"{pt[0]} {pt[1]}" for pt in box) + "\n")
+    for j in range(4):
+        write_image(os.path.join(root, corner_dir, f"DJI_corner{j + 1}.JPG"), 41.9 + (j // 2) * 1e-4, -70.7 + (j % 2) * 1e-4, 12.3, -60, 5)
+    return {"img_dir": img_dir, "label_dir": label_dir, "corner_dir": corner_dir}
+
+
+class _Array:
+    """Tensor stand-in with the two access paths split_predict uses (.tolist() and .cpu().numpy())."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.values
+
+
+class _OBB:
+    def __init__(self, corners, conf):
+        self.xyxyxyxy, self.conf = _Array(corners), _Array(conf)
+
+    def __len__(self):
+        return len(self.conf.values)
+
+
+class _Result:
+    def __init__(self, corners, conf):
+        self.obb = _OBB(corners, conf)
+
+
+class StubDetector:
+    """
+    Stand-in for the YOLO model: model.predict returns OBB results with boxes derived from each tile's pixels
+    Boxes are rotated squares of redroot size, so the cross-tile NMS sees realistic overlaps.
+    param boxes_per_tile: mean number of boxes per tile
+    """
+
+    def __init__(self, boxes_per_tile=40):
+        self.boxes_per_tile = boxes_per_tile
+
+    def predict(self, source, conf=0.25, iou=0.7, **kwargs):
+        results = []
+        for tile in source:
+            rng = np.random.default_rng(int(tile[::97, ::89].sum()))
+            n = rng.poisson(self.boxes_per_tile)
+            boxes = nms_benchmark.random_boxes(n, tile.shape[0], seed=int(rng.integers(1 << 31)))
+            keep = boxes["conf"] >= conf
+            results.append(_Result(boxes["box"][keep], boxes["conf"][keep]))
+        return results
+
+
+def measure(fn, repeat=3):
+    """
+    Time fn (stage progress messages are silenced), then run it once more under tracemalloc for the peak of Python and NumPy allocations
+    return: (seconds of the fastest run, peak MB)
+    """
+    seconds = []
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(seconds), peak / 2**20
+
+
+def run_scale(name, params, work_dir):
+    """Run every stage at one scale, return {stage: {seconds, throughput, unit, peak_mb}}."""
+    root = os.path.join(work_dir, name)
+    flight = make_flight(root, params["images"], params["density"])
+    img_names = sorted(os.listdir(flight["img_dir"]))
+    img_paths = [os.path.join(flight["img_dir"], f) for f in img_names]
+    label_paths = [os.path.join(flight["label_dir"], f.split(".")[0] + ".txt") for f in img_names]
+    origin = img_paths[0]
+    metadata = flight_metadata.FlightMetadata.load(flight["img_dir"], workers=1, use_cache=False)
+    results = {}
+
+    def record(stage, fn, amount, unit, repeat=3):
+        seconds, peak = measure(fn, repeat)
+        results[stage] = {"seconds": round(seconds, 4), "throughput": round(amount / seconds, 2), "unit": unit, "peak_mb": round(peak, 2)}
+        print(f"{name:>7} {stage:>18}: {amount / seconds:>12.1f} {unit}, {seconds:.3f} s, peak {peak:.1f} MB")
+
+    # nms on random rotated boxes
+    boxes = nms_benchmark.random_boxes(params["nms_boxes"], extent=int(np.sqrt(params["nms_boxes"]) * 40), seed=1)
+    record("nms", lambda: nms_module.nms(boxes.copy(), 0.35, 0.5), params["nms_boxes"], "boxes/s")
+
+    # tiling, stub inference and merge (cross-tile NMS, label and store writes) of full-size frames
+    # split_predict imports ultralytics only to load a model, the stub detector runs without it (skipped if another dependency is missing)
+    try:
+        import split_predict
+    except ImportError as e:
+        print(f"{name:>7} {'tiling_merge':>18}: skipped ({e})")
+    else:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 255, (IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8) for _ in range(params["tiling_images"])]
+        model, output_path = StubDetector(), os.path.join(root, "predict")
+        os.makedirs(output_path, exist_ok=True)
+
+        def tile_and_merge():
+            for i, frame in enumerate(frames):
+                tiles, offsets, img = split_predict.make_tiles(frame, 640)
+                tile_results = split_predict.predict_tiles(model, tiles, 640, 0.5, 0.35, 8)
+                split_predict.write_detections(tile_results, offsets, img, f"frame_{i}.JPG", output_path, 640, 0.5, 0.35, save_overlay=False)
+        record("tiling_merge", tile_and_merge, len(frames), "images/s")
+
+    # georeferencing: per-point scalar path, array path and image footprints
+    record("georef", lambda: [georef2.georef(origin, p, l, metadata) for p, l in zip(img_paths, label_paths)], len(img_paths), "images/s")
+    record("georef_array", lambda: [georef2.georef_array(origin, p, l, metadata) for p, l in zip(img_paths, label_paths)], len(img_paths), "images/s")
+    record("image_corners", lambda: [georef2.get_image_corners(origin, p, metadata) for p in img_paths], len(img_paths), "images/s")
+
+    # shift vector from the corner images
+    # a run takes about a millisecond, 20 runs per timing keep the ratio against the baseline stable
+    record("shift_vector", lambda: [shift_vector_module.calculate_shift_vector(root, flight["corner_dir"]) for _ in range(20)], 20, "runs/s")
+
+    # density grid from the georeferenced images (in process, the pool is covered by georef_array)
+    processed = [densitymap.process_img(f, os.path.basename(l), flight["img_dir"], flight["label_dir"], origin, metadata)
+                 for f, l in zip(img_names, label_paths)]
+    origin_record = metadata[origin]
+    yaw = np.radians(90 - origin_record["yaw"])
+    record("density_grid", lambda: densitymap.compute_density(processed, params["side_length"], (origin_record["lat"], origin_record["lon"]), yaw, metadata),
+           len(processed), "images/s")
+    return results
+
+
+def compare(results, baseline):
+    """
+    Throughput of every stage relative to a baseline results file
+    return: list of (scale, stage, ratio) where throughput dropped by more than REGRESSION_TOLERANCE
+    """
+    regressions = []
+    for scale, stages in results["scales"].items():
+        for stage, entry in stages.items():
+            reference = baseline.get("scales", {}).get(scale, {}).get(stage)
+            if reference is None:
+                continue
+            ratio = entry["throughput"] / reference["throughput"]
+            memory = entry["peak_mb"] / reference["peak_mb"] if reference["peak_mb"] else float("nan")
+            flag = "  REGRESSION" if ratio < 1 - REGRESSION_TOLERANCE else ""
+            print(f"{scale:>7} {stage:>18}: {ratio:.2f}x throughput, {memory:.2f}x peak memory{flag}")
+            if flag:
+                regressions.append((scale, stage, ratio))
+    return regressions
+
+
+def run(scales, results_path, baseline_path=None, work_dir=None):
+    """Run the suite at the given scales, write the results file and compare against the baseline file if there is one."""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="redroot_benchmark_")
+    try:
+        results = {"host": socket.gethostname(), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "scales": {name: run_scale(name, SCALES[name], work_dir) for name in scales}}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {results_path}")
+
+    if baseline_path is not None and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f"\nAgainst baseline {baseline_path} ({baseline.get('time')}):")
+        compare(results, baseline)
+    return results
+
+
+if __name__ == "__main__":
+    scales = ["small", "medium"] # add "large" for the full-size run
+    results_path = "benchmark_results.json"
+    baseline_path = "benchmark_baseline.json" # copy a results file here to compare later runs against it
+
+    run(scales, results_path, baseline_path)
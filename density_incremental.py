@@ -0,0 +1,180 @@
+import os, time, numpy as np
+import densitymap, flight_metadata
+from shapely import polygons, bounds
+
+# cells are anchored in the origin frame: cell (i, j) covers [i * side, (i + 1) * side] x [j * side, (j + 1) * side]
+# (x: right, y: forward of the origin image), so the grid can grow in any direction without re-binning
+# cells are stored in square chunks of CHUNK_SIZE x CHUNK_SIZE, allocated when an image footprint first reaches them
+CHUNK_SIZE = 256
+
+
+class Chunk:
+    """Per-cell state of one chunk: chosen image, distance to its lower-half centroid, detections of that image in the cell."""
+
+    def __init__(self, size):
+        self.chosen = np.full((size, size), -1, dtype=np.int32) # index into IncrementalDensityMap.images, -1: none
+        self.best = np.full((size, size), np.inf)
+        self.counts = np.zeros((size, size), dtype=np.int32)
+
+
+class IncrementalDensityMap:
+    """
+    Density map that is updated one image at a time
+    Each cell keeps the image whose footprint envelope touches it and whose lower-half centroid is closest to the cell
+    centroid (ties: the image with the higher waypoint id), and the number of that image's detections in the cell,
+    the same rule as densitymap.compute_density. Adding an image only revisits the cells under its footprint.
+    The grid is anchored at the origin instead of the detection bounds, so cells differ from a batch run of the same flight.
+    param config: densitymap.DensityConfig (paths, side length, threshold, outputs, shift vector)
+    """
+
+    def __init__(self, config, chunk_size=CHUNK_SIZE):
+        self.config = config
+        self.side = config.side_length_meters
+        self.chunk_size = chunk_size
+        self.chunks = {} # (chunk_x, chunk_y) -> Chunk
+        self.images = [] # file names in arrival order
+        self.image_ids = [] # waypoint ids, used for tie breaks
+        self.drone_gps = [] # (lat, lon) of the drone at each image
+        self.has_points = [] # images without detections do not fill their cells
+
+        self.origin_name = os.path.basename(config.origin_path)
+        self.origin_record = flight_metadata.lookup(config.origin_path)
+        self.origin_gps = (self.origin_record["lat"], self.origin_record["lon"])
+        self.yaw = np.radians(90 - self.origin_record["yaw"])
+        self._shift_vector = None
+
+    def __contains__(self, img):
+        return img in self.images
+
+    @property
+    def shift_vector(self):
+        if self._shift_vector is None:
+            self._shift_vector = densitymap.FlightContext(self.config).shift_vector
+        return self._shift_vector
+
+    def add_image(self, img, label=None):
+        """
+        Georeference one image and update the cells under its footprint, an image already in the map is skipped
+        param img: image file name inside config.img_dir
+        param label: label file name inside config.label_dir (default: image name with .txt)
+        return: number of cells whose image or count changed (0 for a skipped image)
+        """
+        if img in self:
+            # a second copy would compete with itself for its cells and be counted twice in the summaries
+            return 0
+        label = label or img.split(".")[0] + ".txt"
+        record = flight_metadata.lookup(os.path.join(self.config.img_dir, img))
+        metadata = flight_metadata.FlightMetadata([self.origin_name, img], np.array([self.origin_record, record]))
+        result = densitymap.process_img(img, label, self.config.img_dir, self.config.label_dir, self.config.origin_path, metadata)
+
+        index = len(self.images)
+        self.images.append(img)
+        self.image_ids.append(result["img_id"])
+        self.drone_gps.append((record["lat"], record["lon"]))
+        self.has_points.append(len(result["mapped_list"]) > 0)
+
+        footprint = polygons(result["footprint"])
+        centroid = densitymap.lower_half_centroids([footprint])[0]
+        if np.isnan(centroid[0]):
+            return 0
+        minx, miny, maxx, maxy = bounds(footprint)
+        # cells whose closed box touches the envelope
+        i0, i1 = int(np.ceil(minx / self.side)) - 1, int(np.floor(maxx / self.side))
+        j0, j1 = int(np.ceil(miny / self.side)) - 1, int(np.floor(maxy / self.side))
+        x_lines = np.arange(i0, i1 + 2) * self.side
+        y_lines = np.arange(j0, j1 + 2) * self.side
+
+        cent_x, cent_y = densitymap.cell_centroids(x_lines, y_lines)
+        dx, dy = cent_x - centroid[0], cent_y - centroid[1]
+        dist = np.sqrt(dx * dx + dy * dy)
+        counts = densitymap.count_cells(x_lines, y_lines, np.zeros(dist.shape, dtype=np.int64), [result["mapped_list"]])
+        return self._update(i0, j0, dist, counts, index)
+
+    def _update(self, i0, j0, dist, counts, index):
+        """Apply an image's distances and counts to the window of cells starting at cell (i0, j0), chunk by chunk."""
+        size, image_id, changed = self.chunk_size, self.image_ids[index], 0
+        rows, cols = dist.shape
+        for chunk_y in range(j0 // size, (j0 + rows - 1) // size + 1):
+            for chunk_x in range(i0 // size, (i0 + cols - 1) // size + 1):
+                chunk = self.chunks.setdefault((chunk_x, chunk_y), Chunk(size))
+                # overlap of the window and the chunk, in chunk and window coordinates
+                cy0, cy1 = max(j0, chunk_y * size), min(j0 + rows, (chunk_y + 1) * size)
+                cx0, cx1 = max(i0, chunk_x * size), min(i0 + cols, (chunk_x + 1) * size)
+                local = np.s_[cy0 - chunk_y * size : cy1 - chunk_y * size, cx0 - chunk_x * size : cx1 - chunk_x * size]
+                window = np.s_[cy0 - j0 : cy1 - j0, cx0 - i0 : cx1 - i0]
+
+                chosen_ids = np.asarray(self.image_ids)[chunk.chosen[local]]
+                closer = (dist[window] < chunk.best[local]) | ((dist[window] == chunk.best[local]) & (chosen_ids < image_id))
+                closer &= np.isfinite(dist[window])
+                chunk.best[local][closer] = dist[window][closer]
+                chunk.chosen[local][closer] = index
+                chunk.counts[local][closer] = counts[window][closer]
+                changed += int(closer.sum())
+        return changed
+
+    def cells(self):
+        """
+        Filled cells in row-major order (forward, then right), like the batch grid
+        return: (j, i) cell indices, detections per square meter, index of the chosen image
+        """
+        j, i, density, chosen = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)], [np.zeros(0, dtype=np.int64)]
+        has_points = np.asarray(self.has_points, dtype=bool)
+        for (chunk_x, chunk_y), chunk in self.chunks.items():
+            filled = chunk.chosen >= 0
+            filled[filled] = has_points[chunk.chosen[filled]]
+            rows, cols = np.nonzero(filled)
+            j.append(rows + chunk_y * self.chunk_size)
+            i.append(cols + chunk_x * self.chunk_size)
+            density.append(chunk.counts[rows, cols] / self.side**2)
+            chosen.append(chunk.chosen[rows, cols].astype(np.int64))
+        j, i, density, chosen = (np.concatenate(a) for a in (j, i, density, chosen))
+        order = np.lexsort((i, j))
+        return j[order], i[order], density[order], chosen[order]
+
+    def gps_map(self):
+        """(lat, lon) -> (density, image file name, (dx, dy) from the drone) of every filled cell, as in DensityMap.gps_map."""
+        j, i, density, chosen = self.cells()
+        center_x, center_y = (i + 0.5) * self.side, (j + 0.5) * self.side
+        lat, lon = densitymap.meters_to_gps(self.origin_gps[0], self.origin_gps[1], center_x, center_y, self.yaw)
+        drone = np.asarray(self.drone_gps).reshape(-1, 2)
+        dx, dy = densitymap.find_displacement(drone_gps=(drone[chosen, 0], drone[chosen, 1]), point_gps=(lat, lon), yaw=self.yaw)
+        return {(cell_lat, cell_lon): (cell_density, self.images[idx], (cell_dx, cell_dy))
+                for cell_lat, cell_lon, cell_density, idx, cell_dx, cell_dy in zip(lat, lon, density, chosen, dx, dy)}
+
+    def write(self):
+        """Rewrite the density and spray CSVs from the current cells (no image is reprocessed)."""
+        densitymap.write_csv(self.gps_map(), self.shift_vector, self.config.threshold, self.config.csv_output, self.config.spray_output)
+
+    def pending(self):
+        """Images of img_dir that have a label file and were not added yet, in file name order."""
+        labels = set(os.listdir(self.config.label_dir))
+        return [img for img in sorted(os.listdir(self.config.img_dir))
+                if img.lower().endswith(".jpg") and img.split(".")[0] + ".txt" in labels and img not in self.images]
+
+    def watch(self, poll_seconds=10, idle_timeout=None):
+        """
+        Poll the image and label folders, add every image whose label has appeared and refresh the CSVs after each poll
+        Labels are moved into place atomically by split_predict, so an existing label file is complete.
+        param idle_timeout: stop after this many seconds without a new image (None: run until interrupted)
+        """
+        last_new = time.monotonic()
+        try:
+            while idle_timeout is None or time.monotonic() - last_new < idle_timeout:
+                new = self.pending()
+                if new:
+                    changed = sum(self.add_image(img) for img in new)
+                    self.write()
+                    last_new = time.monotonic()
+                    print(f"Added {len(new)} images ({len(self.images)} total), {changed} cells updated, maps refreshed")
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            pass
+        self.write()
+
+
+if __name__ == "__main__":
+    # follow a flight while split_predict writes its labels, refreshing the density and spray CSVs as images arrive
+    config = densitymap.DensityConfig()
+    density_map = IncrementalDensityMap(config)
+    density_map.watch(poll_seconds=10)
+    print(f"Done. {len(density_map.images)} images, data saved in {config.csv_output} and {config.spray_output}")
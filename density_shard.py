@@ -0,0 +1,245 @@
+import os, hashlib, numpy as np
+import densitymap, detection_store, profiling
+from shapely import polygons, bounds
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# a flight is split into shards that run independently, on separate machines or as local processes standing in for them
+# 1. georef: shard k georeferences the k-th contiguous range of images (waypoint order) into georef_<k>.npz
+# 2. grid: shard k computes the per-cell state of its part of the grid into grid_<k>.npz,
+#    "images" mode: every cell, for the images of georef shard k
+#    "tiles" mode: the k-th spatial tile of the origin frame grid, for every image whose footprint touches it
+# 3. merge: the partial grids are combined into the same density grid and CSVs as densitymap.run_density
+# every shard file records a stamp of its inputs, a shard is only recomputed when its stamp changed
+GEOREF_FILE = "georef_{:04d}.npz"
+GRID_FILE = "grid_{:04d}.npz"
+
+
+def _stamp(*parts):
+    """Hash of the inputs of a shard file."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(np.ascontiguousarray(part).tobytes() if isinstance(part, np.ndarray) else repr(part).encode())
+    return digest.hexdigest()
+
+
+def _up_to_date(path, stamp):
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as shard:
+        return str(shard["stamp"]) == stamp
+
+
+def _save(path, **arrays):
+    """Write a shard file atomically, so a shard that fails midway leaves no partial file behind."""
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def image_ranges(context, shards):
+    """
+    Split the flight into contiguous ranges of images in waypoint order, one per shard
+    return: list of (image names, label names) per shard
+    """
+    pairs = sorted(zip(context.img_list, context.label_list), key=lambda pair: densitymap.image_id(pair[0]))
+    return [pairs[part[0]:part[-1] + 1] if len(part) else [] for part in np.array_split(np.arange(len(pairs)), shards)]
+
+
+def georef_shard(config, shard, shards, shard_dir, force=False, metadata=None):
+    """
+    Georeference the images of one shard and write their detections and footprints to shard_dir
+    param shard: index of this shard, 0 <= shard < shards
+    param force: recompute even if the shard file is up to date
+    param metadata: flight_metadata.FlightMetadata of the flight, loaded once for all shards (None: load it here)
+    return: path of the shard file
+    """
+    context = densitymap.FlightContext(config)
+    if metadata is not None:
+        context.metadata = metadata
+    pairs = image_ranges(context, shards)[shard]
+    names = [img for img, _ in pairs]
+    if config.detection_store is not None:
+        sources = [os.stat(os.path.join(config.detection_store, name + ".npy")) for name in detection_store.COLUMNS]
+    else:
+        sources = [os.stat(os.path.join(config.label_dir, label)) for _, label in pairs]
+    records = np.array([context.metadata[name] for name in names], dtype=context.metadata.records.dtype)
+    stamp = _stamp(os.path.basename(config.origin_path), context.origin_record, names, records,
+                   np.array([(s.st_size, s.st_mtime_ns) for s in sources], dtype=np.int64))
+    path = os.path.join(shard_dir, GEOREF_FILE.format(shard))
+    if not force and _up_to_date(path, stamp):
+        return path
+
+    store = detection_store.DetectionStore(config.detection_store) if config.detection_store is not None else None
+    with profiling.span("shard_georef", shard=shard, images=len(pairs)):
+        results = [densitymap.process_img(img, label, config.img_dir, config.label_dir, config.origin_path, context.metadata, store)
+                   for img, label in pairs]
+    points = [result["mapped_list"] for result in results]
+    all_points = np.concatenate([np.zeros((0, 2))] + points)
+    _save(path, stamp=stamp, names=np.array(names, dtype=str), points=all_points,
+          point_ptr=np.concatenate([[0], np.cumsum([len(p) for p in points])]).astype(np.int64),
+          footprints=np.stack([result["footprint"] for result in results]) if results else np.zeros((0, 4, 2)),
+          extent=np.concatenate([all_points.min(axis=0), all_points.max(axis=0)]) if len(all_points) else np.array([np.inf, np.inf, -np.inf, -np.inf]))
+    return path
+
+
+def georef_paths(shard_dir, shards):
+    return [os.path.join(shard_dir, GEOREF_FILE.format(k)) for k in range(shards)]
+
+
+def flight_index(config, shard_dir, shards):
+    """
+    Flight-wide view of the georef shards, without loading their detections
+    return: dict with x_lines, y_lines, names (waypoint order, global image indices), offsets (first global index of each
+            georef shard), has_points, footprint bounds (K,4), lower-half centroids (K,2) and stamps of the georef shards
+    """
+    names, point_ptrs, footprints, extents, stamps = [], [], [], [], []
+    for path in georef_paths(shard_dir, shards):
+        with np.load(path) as shard:
+            names.append(shard["names"])
+            point_ptrs.append(shard["point_ptr"])
+            footprints.append(shard["footprints"])
+            extents.append(shard["extent"])
+            stamps.append(str(shard["stamp"]))
+    extents = np.array(extents)
+    x_lines, y_lines = densitymap.grid_lines(extents[:, 0].min(), extents[:, 2].max(), extents[:, 1].min(), extents[:, 3].max(),
+                                             config.side_length_meters)
+    footprints = polygons(np.concatenate(footprints))
+    return {"x_lines": x_lines, "y_lines": y_lines, "names": np.concatenate(names),
+            "offsets": np.concatenate([[0], np.cumsum([len(n) for n in names])]).astype(np.int64),
+            "has_points": np.concatenate([np.diff(ptr) > 0 for ptr in point_ptrs]),
+            "bounds": bounds(footprints), "centroids": densitymap.lower_half_centroids(footprints), "stamps": stamps}
+
+
+def tile_windows(num_y_cells, num_x_cells, tiles):
+    """
+    Split the grid into tiles[0] x tiles[1] rectangles of cells, in row-major order
+    return: list of (row0, row1, col0, col1) windows, empty windows when the grid has fewer rows or columns than tiles
+    """
+    rows = np.array_split(np.arange(num_y_cells), tiles[0])
+    cols = np.array_split(np.arange(num_x_cells), tiles[1])
+    return [(int(r[0]), int(r[-1]) + 1, int(c[0]), int(c[-1]) + 1) if len(r) and len(c) else (0, 0, 0, 0) for r in rows for c in cols]
+
+
+def grid_shard(config, shard, shards, shard_dir, tiles=None, force=False):
+    """
+    Compute the chosen image, the distance to its lower-half centroid and its detection count for the cells of one shard
+    Cells are decided by the rule of densitymap.assign_cells over the shard's images only, merge settles between shards.
+    Only the bounding window of the cells the shard fills is written.
+    param shard: index of this grid shard, georef shard index in "images" mode, tile index (row-major) in "tiles" mode
+    param shards: number of georef shards
+    param tiles: (rows, cols) of spatial tiles for "tiles" mode, None: "images" mode
+    return: path of the partial grid file
+    """
+    index = flight_index(config, shard_dir, shards)
+    x_lines, y_lines, offsets = index["x_lines"], index["y_lines"], index["offsets"]
+    if tiles is None:
+        row0, row1, col0, col1 = 0, len(y_lines) - 1, 0, len(x_lines) - 1
+        candidates = np.arange(offsets[shard], offsets[shard + 1])
+    else:
+        row0, row1, col0, col1 = tile_windows(len(y_lines) - 1, len(x_lines) - 1, tiles)[shard]
+        # images whose footprint envelope touches the closed box of the window
+        minx, miny, maxx, maxy = index["bounds"].T
+        touches = (maxx >= x_lines[col0]) & (minx <= x_lines[col1]) & (maxy >= y_lines[row0]) & (miny <= y_lines[row1])
+        candidates = np.flatnonzero(touches & (row1 > row0) & (col1 > col0))
+    sources = np.unique(np.searchsorted(offsets, candidates, "right") - 1)
+
+    stamp = _stamp(x_lines, y_lines, (row0, row1, col0, col1), candidates, [index["stamps"][k] for k in sources])
+    path = os.path.join(shard_dir, GRID_FILE.format(shard))
+    if not force and _up_to_date(path, stamp):
+        return path
+
+    with profiling.span("shard_grid", shard=shard, images=len(candidates)):
+        # detections of the candidate images, read shard by shard from the georef files
+        points_list = []
+        for k in sources:
+            with np.load(georef_paths(shard_dir, shards)[k]) as georef:
+                points, ptr = georef["points"], georef["point_ptr"]
+            points_list += [points[ptr[i - offsets[k]]:ptr[i - offsets[k] + 1]] for i in candidates if offsets[k] <= i < offsets[k + 1]]
+
+        sub_x, sub_y = x_lines[col0:col1 + 1], y_lines[row0:row1 + 1]
+        chosen, best = densitymap.assign_cells(sub_x, sub_y, index["bounds"][candidates], index["centroids"][candidates])
+        counts = densitymap.count_cells(sub_x, sub_y, chosen, points_list)
+        chosen = np.where(chosen >= 0, candidates[np.maximum(chosen, 0)], -1)
+
+    rows, cols = np.nonzero(chosen >= 0)
+    if len(rows):
+        crop = np.s_[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+        origin = (row0 + rows.min(), col0 + cols.min())
+    else:
+        crop, origin = np.s_[0:0, 0:0], (row0, col0)
+    _save(path, stamp=stamp, origin=np.array(origin, dtype=np.int64), chosen=chosen[crop], best=best[crop], counts=counts[crop])
+    return path
+
+
+def merge(config, shard_dir, shards, grid_shards, context=None):
+    """
+    Combine the partial grids: every cell keeps the image with the closest lower-half centroid, on ties the later image
+    (the order assign_cells visits them in), so the result is the density map of a single-node run
+    param shards: number of georef shards
+    param grid_shards: number of grid shards (shards in "images" mode, rows * cols in "tiles" mode)
+    param context: densitymap.FlightContext of the flight (None: a new one)
+    return: densitymap.DensityMap
+    """
+    if config.dedup_radius is not None:
+        raise ValueError("dedup_radius needs every detection of the flight in one process, it is not supported by sharded runs")
+    context = context or densitymap.FlightContext(config)
+    index = flight_index(config, shard_dir, shards)
+    x_lines, y_lines = index["x_lines"], index["y_lines"]
+    shape = (len(y_lines) - 1, len(x_lines) - 1)
+    chosen, best, counts = np.full(shape, -1, dtype=np.int64), np.full(shape, np.inf), np.zeros(shape, dtype=np.int64)
+
+    with profiling.span("shard_merge", shards=grid_shards, cells=chosen.size):
+        for k in range(grid_shards):
+            with np.load(os.path.join(shard_dir, GRID_FILE.format(k))) as partial:
+                (row0, col0), part_chosen, part_best, part_counts = partial["origin"], partial["chosen"], partial["best"], partial["counts"]
+            window = np.s_[row0:row0 + part_chosen.shape[0], col0:col0 + part_chosen.shape[1]]
+            closer = (part_chosen >= 0) & ((part_best < best[window]) | ((part_best == best[window]) & (part_chosen > chosen[window])))
+            best[window][closer] = part_best[closer]
+            chosen[window][closer] = part_chosen[closer]
+            counts[window][closer] = part_counts[closer]
+
+        density_map = densitymap.build_density_map(x_lines, y_lines, chosen, counts, index["has_points"], list(index["names"]),
+                                                   config.side_length_meters, context.origin_gps, context.yaw, context.metadata)
+    return density_map
+
+
+def run_sharded(config, shards, shard_dir, tiles=None, workers=None, force=False):
+    """
+    Run every shard of a flight as a local process (standing in for one machine each), merge and write the CSV outputs
+    Shards whose inputs did not change since the last run in shard_dir are reused.
+    param shards: number of image-range shards for georeferencing
+    param tiles: (rows, cols) to grid by spatial tiles of the origin frame, None: grid by image range
+    return: densitymap.DensityMap
+    """
+    if config.profile_dir is not None:
+        profiling.enable(config.profile_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    grid_shards = shards if tiles is None else tiles[0] * tiles[1]
+    # the flight metadata is read (and its cache written) once here, not by every shard at the same time
+    context = densitymap.FlightContext(config)
+    with ProcessPoolExecutor(max_workers=workers or min(max(shards, grid_shards), os.cpu_count())) as executor:
+        with profiling.span("shard_georef_pool", shards=shards):
+            list(executor.map(partial(georef_shard, config, shards=shards, shard_dir=shard_dir, force=force, metadata=context.metadata),
+                               range(shards)))
+        with profiling.span("shard_grid_pool", shards=grid_shards):
+            list(executor.map(partial(grid_shard, config, shards=shards, shard_dir=shard_dir, tiles=tiles, force=force), range(grid_shards)))
+
+    density_map = merge(config, shard_dir, shards, grid_shards, context)
+    print(f"Merged {grid_shards} shards")
+    densitymap.write_outputs(density_map, config, context)
+    if config.profile_dir is not None:
+        profiling.print_summary(profiling.merge(config.profile_dir))
+    return density_map
+
+
+if __name__ == "__main__":
+    # local stand-in for a multi-node run: each machine would call georef_shard(config, k, shards, shard_dir) for its k,
+    # then grid_shard(config, k, shards, shard_dir, tiles) once every georef file is in the shared shard_dir,
+    # and one machine calls merge(config, shard_dir, shards, grid_shards) and densitymap.write_outputs
+    config = densitymap.DensityConfig()
+    shards = 8
+    shard_dir = "density_shards"
+    tiles = None # e.g. (2, 4) to split the grid stage by spatial tiles of the origin frame instead of image ranges
+
+    run_sharded(config, shards, shard_dir, tiles)
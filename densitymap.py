@@ -1,56 +1,157 @@
-import georef2, shift_vector_module
-import numpy as np, pyexiv2, os, csv
-from shapely import Polygon, box, Point, STRtree, distance
+import georef2, shift_vector_module, flight_metadata, detection_store, detection_dedup, spray_zones, grid_outputs, autotune, profiling
+import numpy as np, os, csv
+from dataclasses import dataclass
+from functools import cached_property, partial
+import shapely
+from shapely import box
 from concurrent.futures import ProcessPoolExecutor
 
-# setting up paths
+# default paths
 ORIGIN_PATH = "DJI_202508081433_021_PineIslandbog5H3m5x3photo/DJI_20250808143604_0001_D_Waypoint1.JPG"
 IMG_DIR = "DJI_202508081433_021_PineIslandbog5H3m5x3photo"
 LABEL_DIR = "output2"
+CORNER_DIR = "4_corner_bog5"
 
 # SHIFT_VECTOR = np.array([-1.68998787e-05, 6.04827686e-06]) # subject to change
-SHIFT_VECTOR = shift_vector_module.calculate_shift_vector(PARENT_DIR="./", corner_folder_dir="4_corner_bog5")
 THRESHOLD = 20 # subject to change
 
 CSV_OUTPUT = "density_by_gps.csv"
+SPRAY_OUTPUT = "spray_location.csv"
+PLANTS_OUTPUT = "plants_by_gps.csv"
+ZONES_OUTPUT = "spray_zones.geojson" # a CSV with the same name is written next to it
 
 # setting up constants
 SIDE_LENGTH_METERS = 1 # grid square side length in meters
 R_EARTH = 6378137.0  # Earth radius
-yaw = np.radians(90 - float(pyexiv2.Image(ORIGIN_PATH).read_xmp()['Xmp.drone-dji.FlightYawDegree']))
-origin_gps = (float(pyexiv2.Image(ORIGIN_PATH).read_xmp()['Xmp.drone-dji.GpsLatitude']), float(pyexiv2.Image(ORIGIN_PATH).read_xmp()['Xmp.drone-dji.GpsLongitude']))
 
 
-img_list = sorted([f for f in os.listdir(IMG_DIR) if f.lower().endswith(".jpg")])
-label_list = sorted([f for f in os.listdir(LABEL_DIR) if f.lower().endswith(".txt")])
+@dataclass
+class DensityConfig:
+    """Inputs and settings of a density map run, defaults are the bog 5 flight."""
+    origin_path: str = ORIGIN_PATH
+    img_dir: str = IMG_DIR
+    label_dir: str = LABEL_DIR
+    detection_store: str = None # binary detection store written by split_predict, read instead of the label files when set
+    corner_dir: str = CORNER_DIR # corner images used to calibrate the shift vector, relative to parent_dir
+    parent_dir: str = "./"
+    shift_vector: tuple = None # (lat, lon) correction, calibrated from corner_dir when None
+    threshold: float = THRESHOLD
+    side_length_meters: float = SIDE_LENGTH_METERS
+    pyramid_sides: tuple = () # coarser side lengths in meters (multiples of side_length_meters) aggregated from the same grid
+    dedup_radius: float = None # merge detections of different images within this many meters and bin the merged plants, None: count the chosen image per cell
+    csv_output: str = CSV_OUTPUT
+    spray_output: str = SPRAY_OUTPUT
+    plants_output: str = PLANTS_OUTPUT # merged plant list, written when dedup_radius is set
+    zones_output: str = ZONES_OUTPUT # spray zone polygons above threshold, None: not written
+    boom_width_meters: float = None # spray zones are dilated by half the boom width on every side, None: no dilation
+    raster_output: str = None # density_grid as a GeoTIFF (needs rasterio), None: not written
+    raster_tiled: bool = False # tiled, compressed GeoTIFF with overviews
+    parquet_output: str = None # filled cells as a Parquet table (needs pyarrow), None: not written
+    workers: int = None # processes used to georeference images, None: tuned value of this machine (autotune) or one per core
+    threads_per_worker: int = None # BLAS / OpenMP threads of each georef process (needs threadpoolctl), None: tuned value or library defaults
+    profile_dir: str = None # per-stage timings of the run and its workers, merged into a Chrome trace and a JSON summary
+
+
+class FlightContext:
+    """Flight-wide values of a run, each computed on first use and only once."""
+
+    def __init__(self, config):
+        self.config = config
+
+    @cached_property
+    def metadata(self):
+        # pose and size of every image, read once per flight (cached next to img_dir)
+        with profiling.span("metadata"):
+            return flight_metadata.FlightMetadata.load(self.config.img_dir)
+
+    @cached_property
+    def origin_record(self):
+        return flight_metadata.lookup(self.config.origin_path, self.metadata)
+
+    @cached_property
+    def yaw(self):
+        return np.radians(90 - self.origin_record['yaw'])
+
+    @cached_property
+    def origin_gps(self):
+        return (self.origin_record['lat'], self.origin_record['lon'])
+
+    @cached_property
+    def shift_vector(self):
+        if self.config.shift_vector is not None:
+            return np.asarray(self.config.shift_vector, dtype=np.float64)
+        with profiling.span("shift_vector"):
+            return shift_vector_module.calculate_shift_vector(PARENT_DIR=self.config.parent_dir, corner_folder_dir=self.config.corner_dir)
+
+    @cached_property
+    def img_list(self):
+        return sorted([f for f in os.listdir(self.config.img_dir) if f.lower().endswith(".jpg")])
+
+    @cached_property
+    def label_list(self):
+        if self.config.detection_store is not None:
+            return [None] * len(self.img_list)
+        return sorted([f for f in os.listdir(self.config.label_dir) if f.lower().endswith(".txt")])
+
+
+@dataclass
+class DensityMap:
+    """Result of a density map run."""
+    density_grid: np.ndarray # (num_y_cells, num_x_cells) detections per square meter
+    x_lines: np.ndarray # grid lines in meters, origin frame (x: right, y: forward of the origin image)
+    y_lines: np.ndarray
+    chosen: np.ndarray # (num_y_cells, num_x_cells) index into img_names of the image used for each cell, -1: none
+    counts: np.ndarray # (num_y_cells, num_x_cells) detections counted in each filled cell, 0 elsewhere
+    filled: np.ndarray # (num_y_cells, num_x_cells) cells that are part of the map (chosen image with detections)
+    side_length_meters: float
+    img_names: list # image file names in image id order
+    gps_map: dict # (lat, lon) -> (density, image_fname, (dx, dy)) for each grid cell center
+    plants: np.ndarray = None # (M,2) deduplicated detections in the origin frame, when the map was built from them
 
 
-# mapping detections to relative coordinate with drone's first image as basis
-# y direction is drone's forward direction
-# x direction is always orthogonal to y direction to the right
-detections = {} # image_id -> list of (x,y) detections in relative coordinate system
-img_fname_map = {} # image_id -> image file name
-image_bounds = {}
-lower_half_image_bounds = {}
-all_detections_coor = [] # list of all (x,y) detections in relative coordinate system for all images, used to determine grid size and bounds
+# helper methods
+def image_id(img):
+    """Waypoint number of an image file name."""
+    return int(img.split("Waypoint")[1].split(".")[0])
 
-gps_map = {} # (lat, lon) -> (density, image_fname) mapping for each grid cell center
 
-# helper methods
-def process_img(img, label):
-    img_path = os.path.join(IMG_DIR, img)
-    img_id = int(img.split("Waypoint")[1].split(".")[0])
-    label_path = os.path.join(LABEL_DIR, label)
-    mapped_list = georef2.georef(ORIGIN_PATH, img_path, label_path)
-    polygon = Polygon(georef2.get_image_corners(ORIGIN_PATH, img_path))
-
-    return {
-        "img": img,
-        "img_id": img_id,
-        "img_path": img_path,
-        "mapped_list": mapped_list,
-        "polygon": polygon
-    }
+# per-process state of the georef workers, set once by init_worker instead of being pickled with every task
+_metadata = None
+_store = None
+
+def init_worker(metadata=None, store_path=None, threads=None):
+    """Keep the flight metadata and the opened detection store for every image the worker processes, optionally limit its threads."""
+    global _metadata, _store
+    if threads is not None:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    _metadata = metadata
+    _store = detection_store.DetectionStore(store_path) if store_path is not None else None
+
+
+def process_img(img, label, img_dir, label_dir, origin_path, metadata=None, store=None):
+    """
+    Georeference the detections and the footprint of one image (runs in the worker processes)
+    Only plain arrays are returned, the footprint polygon is built in the parent where the grid needs it.
+    param metadata: FlightMetadata of the flight, the worker's copy from init_worker when omitted
+    param store: DetectionStore to read the image's rows from instead of the label file, the worker's store when omitted
+    return: dict with img, img_id, mapped_list ((N,2) detections in the origin frame) and footprint ((4,2) image corners)
+    """
+    metadata = metadata if metadata is not None else _metadata
+    store = store if store is not None else _store
+    img_path = os.path.join(img_dir, img)
+    with profiling.span("georef", image=img):
+        if store is not None:
+            detections = store[img]["corners"] if img in store else np.zeros((0, 4, 2))
+        else:
+            detections = os.path.join(label_dir, label)
+
+        return {
+            "img": img,
+            "img_id": image_id(img),
+            "mapped_list": georef2.georef_array(origin_path, img_path, detections, metadata),
+            "footprint": np.asarray(georef2.get_image_corners(origin_path, img_path, metadata), dtype=np.float64)
+        }
 
 def meters_to_gps(lat_origin, lon_origin, dx, dy, yaw_angle):
     """
@@ -102,119 +203,407 @@ def get_lower_half_centroid(polygon):
         return None
     return lower_half_polygon.centroid
 
+def cell_centroids(x_lines, y_lines):
+    """
+    Centroid of every grid cell, bit-identical to box(left, down, right, up).centroid
+    The GEOS polygon centroid (triangle fan from the first ring vertex) is reproduced with array arithmetic,
+    because the plain midpoint differs from it in the last bits.
+    return: (num_y_cells, num_x_cells) arrays of centroid x and y
+    """
+    left, right = x_lines[None, :-1], x_lines[None, 1:]
+    down, up = y_lines[:-1, None], y_lines[1:, None]
+    # box ring: (right, down) -> (right, up) -> (left, up) -> (left, down), fan triangles with non-zero area
+    area_1 = (right - right) * (up - down) - (left - right) * (up - down)
+    area_2 = (left - right) * (down - down) - (left - right) * (up - down)
+    x = (area_1 * (right + right + left) + area_2 * (right + left + left)) / 3 / (area_1 + area_2)
+    y = (area_1 * (down + up + up) + area_2 * (down + up + down)) / 3 / (area_1 + area_2)
+    return x, y
 
 
-# main
-if __name__ == "__main__":
-    # multithreading for image processing
-    print("Processing annotated images...")
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(process_img, img_list, label_list))
+def lower_half_centroids(polygons):
+    """
+    Lower-half centroid of every image footprint, computed once per image
+    return: (K,2) array, NaN for footprints without a lower half
+    """
+    centroids = np.full((len(polygons), 2), np.nan)
+    for k, polygon in enumerate(polygons):
+        centroid = get_lower_half_centroid(polygon)
+        if centroid is not None:
+            centroids[k] = centroid.x, centroid.y
+    return centroids
 
-    for result in results:
-        all_detections_coor.extend(result["mapped_list"])
-        detections[result["img_id"]] = result["mapped_list"]
-        image_bounds[result["img_id"]] = result["polygon"]
-        img_fname_map[result["img_id"]] = result["img"]
-        
-    all_detections_coor = np.array(all_detections_coor) # convert list to numpy array for easier processing later
-    detections = {img_id: np.array(weed) for img_id, weed in detections.items()} # convert lists to numpy arrays for easier processing later
-
-    id_list = np.sort(np.array(list(image_bounds.keys())))
-    img_bounds_ordered = np.array([image_bounds[img_id] for img_id in id_list])
-    tree = STRtree(img_bounds_ordered)
-    if tree is not None:
-        print("Successfully built spatial index for image bounds.")
-    else: 
-        print("Failed to build spatial index for image bounds.")
-        raise Exception("Spatial index construction failed.")
-    
 
-    print("Finished processing images and mapping detections to relative coordinates with origin of drone's first image. \n")
+def assign_cells(x_lines, y_lines, bounds, centroids):
+    """
+    Choose an image for every grid cell: among the images whose footprint envelope intersects the cell,
+    the one whose lower-half centroid is closest to the cell centroid (on ties the later image wins)
+    param bounds: (K,4) array of footprint envelopes (minx, miny, maxx, maxy)
+    param centroids: (K,2) array of lower-half centroids
+    return: (num_y_cells, num_x_cells) array of chosen image indices (-1: no image), distance to the chosen centroid
+    """
+    cent_x, cent_y = cell_centroids(x_lines, y_lines)
+    chosen = np.full(cent_x.shape, -1, dtype=np.int64)
+    best = np.full(cent_x.shape, np.inf)
+    for k, ((minx, miny, maxx, maxy), (gx, gy)) in enumerate(zip(bounds, centroids)):
+        if np.isnan(gx):
+            continue
+        # cells whose box touches the envelope: right >= minx and left <= maxx (same for y)
+        x0, x1 = np.searchsorted(x_lines[1:], minx, "left"), np.searchsorted(x_lines[:-1], maxx, "right")
+        y0, y1 = np.searchsorted(y_lines[1:], miny, "left"), np.searchsorted(y_lines[:-1], maxy, "right")
+        if x0 >= x1 or y0 >= y1:
+            continue
+        dx = cent_x[y0:y1, x0:x1] - gx
+        dy = cent_y[y0:y1, x0:x1] - gy
+        dist = np.sqrt(dx * dx + dy * dy)
+        closer = dist <= best[y0:y1, x0:x1]
+        best[y0:y1, x0:x1][closer] = dist[closer]
+        chosen[y0:y1, x0:x1][closer] = k
+    return chosen, best
+
+
+def cell_span(lines, values):
+    """First and last cell index whose closed interval [lines[i], lines[i+1]] contains each value (first > last: none)."""
+    first = np.maximum(np.searchsorted(lines, values, "left") - 1, 0)
+    last = np.minimum(np.searchsorted(lines, values, "right") - 1, len(lines) - 2)
+    return first, last
+
+
+def count_cells(x_lines, y_lines, chosen, points_list):
+    """
+    Count, for every cell, the detections of its chosen image that lie in the cell
+    Cell bounds are closed, so a point on a grid line counts in both neighbouring cells.
+    param chosen: cell -> image index array from assign_cells
+    param points_list: (N,2) detection array of every image, in image index order
+    return: (num_y_cells, num_x_cells) int array of counts
+    """
+    num_x_cells = len(x_lines) - 1
+    flat_chosen = chosen.ravel()
+    hits = [np.zeros(0, dtype=np.int64)]
+    for k, points in enumerate(points_list):
+        if len(points) == 0:
+            continue
+        x_first, x_last = cell_span(x_lines, points[:, 0])
+        y_first, y_last = cell_span(y_lines, points[:, 1])
+        for x_step in (0, 1):
+            for y_step in (0, 1):
+                col, row = x_first + x_step, y_first + y_step
+                valid = (col <= x_last) & (row <= y_last)
+                flat = row[valid] * num_x_cells + col[valid]
+                hits.append(flat[flat_chosen[flat] == k])
+    return np.bincount(np.concatenate(hits), minlength=chosen.size).reshape(chosen.shape)
+
+
+
+def bin_points(x_lines, y_lines, points):
+    """
+    Count points per grid cell, each point in exactly one cell (half-open cells, the last row and column closed)
+    return: (num_y_cells, num_x_cells) int array of counts
+    """
+    num_x_cells, num_y_cells = len(x_lines) - 1, len(y_lines) - 1
+    col = np.clip(np.searchsorted(x_lines, points[:, 0], "right") - 1, 0, num_x_cells - 1)
+    row = np.clip(np.searchsorted(y_lines, points[:, 1], "right") - 1, 0, num_y_cells - 1)
+    return np.bincount(row * num_x_cells + col, minlength=num_x_cells * num_y_cells).reshape(num_y_cells, num_x_cells)
+
+
+def georef_flight(context):
+    """Georeference every image of the flight in a process pool."""
+    config = context.config
+    process = partial(process_img, img_dir=config.img_dir, label_dir=config.label_dir, origin_path=config.origin_path)
+    threads = config.threads_per_worker or autotune.tuned_setting("density", "threads")
+    with ProcessPoolExecutor(max_workers=config.workers or autotune.tuned_setting("density", "workers"), initializer=init_worker,
+                             initargs=(context.metadata, config.detection_store, threads)) as executor:
+        return list(executor.map(process, context.img_list, context.label_list, chunksize=8))
 
-    # create grids
-    x_min, x_max = np.min(all_detections_coor[:,0]), np.max(all_detections_coor[:,0])
-    y_min, y_max = np.min(all_detections_coor[:,1]), np.max(all_detections_coor[:,1])
 
+def grid_lines(x_min, x_max, y_min, y_max, side_length_meters):
+    """
+    Grid lines spanning the detection bounds, in the origin frame
+    return: x_lines, y_lines
+    """
     # number of cells in x and y direction
     # y is the drone's forward direction, x is the right direction orthogonal to y
-    num_x_cells = int(np.ceil((x_max - x_min) / SIDE_LENGTH_METERS))
+    num_x_cells = int(np.ceil((x_max - x_min) / side_length_meters))
     print(f"Number of cells in x direction: {num_x_cells}")
-    num_y_cells = int(np.ceil((y_max - y_min) / SIDE_LENGTH_METERS))
+    num_y_cells = int(np.ceil((y_max - y_min) / side_length_meters))
     print(f"Number of cells in y direction: {num_y_cells} \n")
 
-    # create cells
-    density_grid = np.zeros((num_y_cells, num_x_cells), dtype=int) # a matrix of dimension num_y_cells x num_x_cells initialized to 0 
-
-    # create grid lines
     y_lines = np.linspace(start=y_min, stop=y_max, num=num_y_cells+1)
     x_lines = np.linspace(start=x_min, stop=x_max, num=num_x_cells+1)
+    return x_lines, y_lines
 
 
+def compute_density(results, side_length_meters, origin_gps, yaw, metadata, dedup_radius=None):
+    """
+    Build the density grid from the georeferenced images
+    param results: process_img outputs
+    param origin_gps: (lat, lon) of the origin image
+    param yaw: yaw of the origin image (radians, mathematical angle)
+    param metadata: FlightMetadata of the flight
+    param dedup_radius: merge detections of overlapping images (detection_dedup) and count every merged plant in its cell,
+                        None: count the detections of the image chosen for each cell
+    return: DensityMap
+    """
+    # mapping detections to relative coordinate with drone's first image as basis
+    # y direction is drone's forward direction
+    # x direction is always orthogonal to y direction to the right
+    detections = {} # image_id -> (x,y) detections in relative coordinate system
+    img_fname_map = {} # image_id -> image file name
+    footprints = {} # image_id -> (4,2) image corners
+
+    for result in results:
+        detections[result["img_id"]] = result["mapped_list"]
+        footprints[result["img_id"]] = result["footprint"]
+        img_fname_map[result["img_id"]] = result["img"]
+
+    id_list = np.sort(np.array(list(footprints.keys())))
+    # all (x,y) detections in relative coordinate system, used to determine grid size and bounds
+    all_detections_coor = np.concatenate([np.zeros((0, 2))] + [detections[img_id] for img_id in id_list])
+
+    # create grids
+    x_min, x_max = np.min(all_detections_coor[:,0]), np.max(all_detections_coor[:,0])
+    y_min, y_max = np.min(all_detections_coor[:,1]), np.max(all_detections_coor[:,1])
+    x_lines, y_lines = grid_lines(x_min, x_max, y_min, y_max, side_length_meters)
+
     print("Density calculation started...")
     # density calculation
-    for y_idx in range(num_y_cells):
-        for x_idx in range(num_x_cells):
-            up, down = y_lines[y_idx+1], y_lines[y_idx]
-            left, right = x_lines[x_idx], x_lines[x_idx+1]
-            cell_bounds = box(left, down, right, up)
-            cell_center_x, cell_center_y = (left + right) / 2, (down + up) / 2
- 
-            possible_bounds = tree.query(cell_bounds) # 1d array of possible intersecting polygons (in any region)
-
-            # choosing best image
-            min_distance = float("inf")
-            chosen_img = None
-            for idx in possible_bounds:
-                img_id = id_list[idx]
-                polygon = image_bounds[img_id]
-                distance_to_centroid = abs(distance(cell_bounds.centroid, get_lower_half_centroid(polygon)))
-                if distance_to_centroid <= min_distance:
-                    chosen_img = img_id
-                    min_distance = distance_to_centroid 
-                            
-            if chosen_img is not None:
-                points = detections[chosen_img]
-                # print(f"{img_id}: {np.ndim(points)}")
-                if points.ndim != 2:
-                    print(f"Warning: No detections found for image {img_id}. Skipping this cell.")
-                    continue
-                is_in_x = (points[:,0] >= left) & (points[:,0] <= right)
-                is_in_y = (points[:,1] >= down) & (points[:,1] <= up)
-                count = np.count_nonzero(is_in_x & is_in_y)
-                density = count / SIDE_LENGTH_METERS**2  # density per square meter
-                density_grid[y_idx, x_idx] = density
-
-                # map cell center to GPS 
-                gps = meters_to_gps(origin_gps[0], origin_gps[1], cell_center_x, cell_center_y, yaw)
-                xmp_data = pyexiv2.Image(os.path.join(IMG_DIR, img_fname_map[chosen_img])).read_xmp()
-                drone_gps = (float(xmp_data['Xmp.drone-dji.GpsLatitude']), float(xmp_data['Xmp.drone-dji.GpsLongitude']))
-                displacement = find_displacement(drone_gps=drone_gps, point_gps=gps, yaw=yaw)
-                gps_map[gps] = (density, img_fname_map[chosen_img], displacement)
+    points_list = [detections[img_id] for img_id in id_list]
+    with profiling.span("index_build", images=len(id_list)):
+        img_bounds_ordered = shapely.polygons(np.stack([footprints[img_id] for img_id in id_list]))
+        footprint_bounds = shapely.bounds(img_bounds_ordered)
+        chosen, _ = assign_cells(x_lines, y_lines, footprint_bounds, lower_half_centroids(img_bounds_ordered))
+
+    has_points = np.array([len(points) > 0 for points in points_list])
+    plants = None
+    if dedup_radius is not None:
+        image = np.repeat(np.arange(len(points_list)), [len(points) for points in points_list])
+        plants, _, _ = detection_dedup.deduplicate(all_detections_coor, image, dedup_radius)
+        print(f"Merged {len(all_detections_coor)} detections into {len(plants)} plants")
+        has_points[:] = True # plants are counted in every covered cell, whichever image saw them
+    with profiling.span("grid", cells=chosen.size):
+        counts = count_cells(x_lines, y_lines, chosen, points_list) if plants is None else bin_points(x_lines, y_lines, plants)
+        density_map = build_density_map(x_lines, y_lines, chosen, counts, has_points, [img_fname_map[img_id] for img_id in id_list],
+                                        side_length_meters, origin_gps, yaw, metadata)
+    density_map.plants = plants
     print("Finished density map calculation\n")
+    return density_map
+
+
+def cell_positions(x_lines, y_lines, filled, chosen, img_names, origin_gps, yaw, metadata):
+    """
+    Positions of the filled cells, in the row-major order of the original cell loop
+    return: row, col, center x and y in the origin frame, lat, lon of the center, dx, dy from the drone of the chosen image
+    """
+    y_idx, x_idx = np.nonzero(filled)
+    cell_center_x = (x_lines[x_idx] + x_lines[x_idx + 1]) / 2
+    cell_center_y = (y_lines[y_idx] + y_lines[y_idx + 1]) / 2
+    lat, lon = meters_to_gps(origin_gps[0], origin_gps[1], cell_center_x, cell_center_y, yaw)
+    cell_img = chosen[y_idx, x_idx]
+    drone_records = np.array([metadata[name] for name in img_names], dtype=flight_metadata.METADATA_DTYPE)
+    dx, dy = find_displacement(drone_gps=(drone_records['lat'][cell_img], drone_records['lon'][cell_img]), point_gps=(lat, lon), yaw=yaw)
+    return y_idx, x_idx, cell_center_x, cell_center_y, lat, lon, dx, dy
+
+
+def cell_columns(density_map, origin_gps, yaw, shift_vector, metadata):
+    """
+    Every filled cell of a density map as columns, in the row order of the CSV (shift vector applied to lat / lon)
+    return: dict of arrays: row, col, latitude, longitude, density, count, image (index into img_names), center_x, center_y, dx, dy
+    """
+    row, col, center_x, center_y, lat, lon, dx, dy = cell_positions(density_map.x_lines, density_map.y_lines, density_map.filled,
+                                                                    density_map.chosen, density_map.img_names, origin_gps, yaw, metadata)
+    counts = density_map.counts[row, col]
+    return {"row": row.astype(np.int32), "col": col.astype(np.int32), "latitude": lat + shift_vector[0], "longitude": lon + shift_vector[1],
+            "density": counts / density_map.side_length_meters**2, "count": counts.astype(np.int32),
+            "image": density_map.chosen[row, col].astype(np.int32), "center_x": center_x, "center_y": center_y, "dx": dx, "dy": dy}
+
+
+def build_density_map(x_lines, y_lines, chosen, counts, has_points, img_names, side_length_meters, origin_gps, yaw, metadata):
+    """
+    Density grid and GPS cell map from the per-cell state (chosen image and its detection count)
+    param chosen: (num_y_cells, num_x_cells) index into img_names, -1: none
+    param counts: (num_y_cells, num_x_cells) detections of the chosen image in each cell
+    param has_points: (K,) whether each image has detections, cells of images without any are left empty
+    param img_names: image file names in image id order
+    return: DensityMap
+    """
+    gps_map = {} # (lat, lon) -> (density, image_fname) mapping for each grid cell center
+    density_grid = np.zeros(chosen.shape, dtype=int) # a matrix of dimension num_y_cells x num_x_cells initialized to 0
+
+    for idx in np.unique(chosen[chosen >= 0]):
+        if not has_points[idx]:
+            print(f"Warning: No detections found for image {image_id(img_names[idx])}. Skipping its cells.")
+    filled = chosen >= 0
+    filled[filled] = has_points[chosen[filled]]
+
+    density = counts / side_length_meters**2  # density per square meter
+    density_grid[filled] = density[filled]
+
+    y_idx, x_idx, _, _, lat, lon, dx, dy = cell_positions(x_lines, y_lines, filled, chosen, img_names, origin_gps, yaw, metadata)
+    cell_img = chosen[y_idx, x_idx]
+    for cell_lat, cell_lon, cell_density, idx, cell_dx, cell_dy in zip(lat, lon, density[y_idx, x_idx], cell_img, dx, dy):
+        gps_map[(cell_lat, cell_lon)] = (cell_density, img_names[idx], (cell_dx, cell_dy))
+
+    return DensityMap(density_grid=density_grid, x_lines=x_lines, y_lines=y_lines, chosen=chosen, counts=np.where(filled, counts, 0),
+                      filled=filled, side_length_meters=side_length_meters, img_names=list(img_names), gps_map=gps_map)
 
-    # output
-    print("Run summary:")
-    print("Total images with detections:", len(image_bounds))
-    print("Total detection files loaded:", len(detections))
-    print("Nonzero grid cells:", np.count_nonzero(density_grid))
-    print("Max density in a cell: ", np.max(density_grid))
-    print(f"Origin GPS: lat {origin_gps[0]}, lon {origin_gps[1]}")
-    print(f"Shift vector: lat {SHIFT_VECTOR[0]}, lon {SHIFT_VECTOR[1]}\n")
 
+def coarse_lines(lines, factor):
+    """Every factor-th grid line, extended past the last one with the fine spacing when the cells do not divide evenly."""
+    num_cells = -(-(len(lines) - 1) // factor)
+    step = lines[1] - lines[0] if len(lines) > 1 else 0.0
+    coarse = lines[0] + np.arange(num_cells + 1) * factor * step
+    exact = lines[::factor]
+    coarse[:len(exact)] = exact
+    return coarse
+
+
+def coarsen(density_map, side_length_meters, origin_gps, yaw, metadata):
+    """
+    Aggregate a density map into factor x factor blocks of its cells, without choosing images again
+    A coarse cell sums the counts of its filled fine cells and takes the image chosen for most of them
+    (ties: the earlier image), the GPS conversion only runs for the coarse cells.
+    param side_length_meters: coarse side length, an integer multiple of density_map.side_length_meters
+    return: DensityMap at the coarse side length
+    """
+    factor = int(round(side_length_meters / density_map.side_length_meters))
+    if factor < 1 or not np.isclose(factor * density_map.side_length_meters, side_length_meters):
+        raise ValueError(f"Pyramid side {side_length_meters} m is not a multiple of {density_map.side_length_meters} m")
+    x_lines, y_lines = coarse_lines(density_map.x_lines, factor), coarse_lines(density_map.y_lines, factor)
+    num_x_cells = len(x_lines) - 1
+    shape = (len(y_lines) - 1, num_x_cells)
+
+    rows, cols = np.nonzero(density_map.filled)
+    cell = (rows // factor) * num_x_cells + cols // factor
+    counts = np.bincount(cell, weights=density_map.counts[rows, cols], minlength=shape[0] * shape[1]).astype(np.int64)
+
+    # majority image of each coarse cell: count (cell, image) pairs, then keep the most frequent pair of every cell
+    pairs, votes = np.unique(np.stack([cell, density_map.chosen[rows, cols]]), axis=1, return_counts=True)
+    order = np.lexsort((pairs[1], -votes, pairs[0]))
+    first = order[np.r_[True, pairs[0][order][1:] != pairs[0][order][:-1]]] if len(order) else order
+    chosen = np.full(shape[0] * shape[1], -1, dtype=np.int64)
+    chosen[pairs[0][first]] = pairs[1][first]
+
+    has_points = np.ones(len(density_map.img_names), dtype=bool) # only filled cells vote, so every chosen image has detections
+    return build_density_map(x_lines, y_lines, chosen.reshape(shape), counts.reshape(shape), has_points, density_map.img_names,
+                             side_length_meters, origin_gps, yaw, metadata)
+
+
+def pyramid(density_map, sides, origin_gps, yaw, metadata):
+    """
+    Coarser levels of a density map, each aggregated from the finest grid
+    param sides: coarse side lengths in meters
+    return: dict side length -> DensityMap
+    """
+    levels = {}
+    for side in sides:
+        with profiling.span("pyramid_level", side=side):
+            levels[side] = coarsen(density_map, side, origin_gps, yaw, metadata)
+    return levels
 
 
-    with open(CSV_OUTPUT, "w", newline='') as f1, open("spray_location.csv", "w", newline='') as f2:
+def level_path(path, side_length_meters):
+    """Output path of a pyramid level: density_by_gps.csv -> density_by_gps_2m.csv."""
+    root, ext = os.path.splitext(path)
+    return f"{root}_{side_length_meters:g}m{ext}"
+
+
+def write_csv(gps_map, shift_vector, threshold, csv_output, spray_output):
+    """Write every grid cell and the cells above threshold as GPS points for QGIS and the sprayer."""
+    with open(csv_output, "w", newline='') as f1, open(spray_output, "w", newline='') as f2:
         writer1 = csv.writer(f1)
         writer2 = csv.writer(f2)
 
         writer1.writerow(["latitude", "longitude", "density", "image_id", "center_x", "center_y"])
         writer2.writerow(["latitude", "longitude", "density", "image_id"])
 
-        for (lat, lon), (density, image_fname, center_xy) in gps_map.items(): 
-            writer1.writerow([lat + SHIFT_VECTOR[0], lon + SHIFT_VECTOR[1], density, image_fname, center_xy[0], center_xy[1]])
-            if density > THRESHOLD:
-                writer2.writerow([lat + SHIFT_VECTOR[0], lon + SHIFT_VECTOR[1], density, image_fname])
+        for (lat, lon), (density, image_fname, center_xy) in gps_map.items():
+            writer1.writerow([lat + shift_vector[0], lon + shift_vector[1], density, image_fname, center_xy[0], center_xy[1]])
+            if density > threshold:
+                writer2.writerow([lat + shift_vector[0], lon + shift_vector[1], density, image_fname])
+
+
+def write_plants(plants, origin_gps, yaw, shift_vector, plants_output):
+    """Write the deduplicated plants as GPS points."""
+    lat, lon = meters_to_gps(origin_gps[0], origin_gps[1], plants[:, 0], plants[:, 1], yaw)
+    with open(plants_output, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["latitude", "longitude", "x", "y"])
+        writer.writerows(zip(lat + shift_vector[0], lon + shift_vector[1], plants[:, 0], plants[:, 1]))
+
+
+def write_outputs(density_map, config, context):
+    """
+    Write the CSVs (and the GeoTIFF / Parquet outputs when configured) of the density map and of every pyramid level
+    in config.pyramid_sides, the plant list and the spray zones
+    return: dict side length -> DensityMap of the pyramid levels
+    """
+    levels = pyramid(density_map, config.pyramid_sides, context.origin_gps, context.yaw, context.metadata)
+    # output paths of a level: the configured paths for the finest grid, suffixed with the side length for pyramid levels
+    outputs = [(density_map, lambda path: path)]
+    outputs += [(level, partial(level_path, side_length_meters=side)) for side, level in levels.items()]
+    crs = grid_outputs.crs_proj4(context.origin_gps, context.shift_vector)
+    for level, output_path in outputs:
+        csv_output = output_path(config.csv_output)
+        with profiling.span("csv_write", cells=len(level.gps_map)):
+            write_csv(level.gps_map, context.shift_vector, config.threshold, csv_output, output_path(config.spray_output))
+        print(f"Data saved for QGIS in {csv_output} ({level.side_length_meters:g} m cells)")
+        if config.raster_output is not None:
+            grid_outputs.write_geotiff(level, context.origin_gps, context.yaw, context.shift_vector, output_path(config.raster_output),
+                                       config.raster_tiled)
+            print(f"Raster saved in {output_path(config.raster_output)}")
+        if config.parquet_output is not None:
+            columns = cell_columns(level, context.origin_gps, context.yaw, context.shift_vector, context.metadata)
+            grid_outputs.write_parquet(columns, level.img_names, level.side_length_meters, crs, output_path(config.parquet_output))
+            print(f"Cell table saved in {output_path(config.parquet_output)}")
+    if density_map.plants is not None:
+        with profiling.span("csv_write", cells=len(density_map.plants)):
+            write_plants(density_map.plants, context.origin_gps, context.yaw, context.shift_vector, config.plants_output)
+        print(f"Plant list saved in {config.plants_output}")
+    if config.zones_output is not None:
+        zones = spray_zones.extract_zones(density_map, config.threshold, context.origin_gps, context.yaw, context.shift_vector,
+                                          config.boom_width_meters)
+        spray_zones.write_geojson(zones, config.zones_output)
+        spray_zones.write_csv(zones, os.path.splitext(config.zones_output)[0] + ".csv")
+        print(f"{len(zones.cells)} spray zones saved in {config.zones_output}")
+    return levels
+
+
+def run_density(config):
+    """
+    Compute the density map of a flight and write the CSV outputs, at the finest side length and every pyramid level
+    param config: DensityConfig
+    return: DensityMap at config.side_length_meters
+    """
+    if config.profile_dir is not None:
+        profiling.enable(config.profile_dir)
+    context = FlightContext(config)
 
-    print(f"Data saved for QGIS in {CSV_OUTPUT}")
-    print("Done.")
\ No newline at end of file
+    # multiprocessing for image processing
+    print("Processing annotated images...")
+    with profiling.span("georef_pool", images=len(context.img_list)):
+        results = georef_flight(context)
+    print("Finished processing images and mapping detections to relative coordinates with origin of drone's first image. \n")
+
+    density_map = compute_density(results, config.side_length_meters, context.origin_gps, context.yaw, context.metadata, config.dedup_radius)
+    density_grid = density_map.density_grid
+    shift_vector = context.shift_vector
+
+    # output
+    print("Run summary:")
+    print("Total images with detections:", sum(len(result["mapped_list"]) > 0 for result in results))
+    print("Total detection files loaded:", len(results))
+    print("Total detections mapped:", sum(len(result["mapped_list"]) for result in results))
+    print("Nonzero grid cells:", np.count_nonzero(density_grid))
+    print("Max density in a cell: ", np.max(density_grid))
+    print(f"Origin GPS: lat {context.origin_gps[0]}, lon {context.origin_gps[1]}")
+    print(f"Shift vector: lat {shift_vector[0]}, lon {shift_vector[1]}\n")
+
+    write_outputs(density_map, config, context)
+    if config.profile_dir is not None:
+        profiling.print_summary(profiling.merge(config.profile_dir))
+    print("Done.")
+    return density_map
+
+
+# main
+if __name__ == "__main__":
+    run_density(DensityConfig())
@@ -0,0 +1,162 @@
+import time, numpy as np
+import profiling
+
+# detections of overlapping images are merged through a uniform spatial hash in the origin frame:
+# points are bucketed by cells of side radius, so two points within radius are in the same or adjacent buckets
+# and only those bucket pairs are compared (near-linear in the number of points, never all images against each other)
+RADIUS = 0.15 # meters, two detections from different images closer than this are the same plant
+PAIR_CHUNK = 1 << 16 # points whose candidate pairs are generated at once, bounds the memory of the pair arrays
+
+# neighbour buckets visited from each bucket, every unordered pair of adjacent buckets appears once
+NEIGHBOURS = ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+
+def neighbour_pairs(points, image, radius):
+    """
+    Pairs of detections from different images that are at most radius apart
+    param points: (N,2) detections in meters, origin frame
+    param image: (N,) index of the image of each detection
+    return: (P,) and (P,) indices into points, i < j never repeated
+    """
+    keys = np.floor(points / radius).astype(np.int64)
+    keys -= keys.min(axis=0) - 1 # keep neighbour keys non-negative
+    width = keys[:, 0].max() + 2
+    flat = keys[:, 1] * width + keys[:, 0]
+    order = np.argsort(flat, kind="stable")
+    sorted_flat = flat[order]
+
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for dx, dy in NEIGHBOURS:
+        target = sorted_flat + dy * width + dx
+        start = np.searchsorted(sorted_flat, target, "left")
+        end = np.searchsorted(sorted_flat, target, "right")
+        if dx == 0 and dy == 0:
+            start = np.arange(len(points)) + 1 # same bucket: only the points after this one
+        for lo in range(0, len(points), PAIR_CHUNK):
+            counts = np.maximum(end[lo:lo + PAIR_CHUNK] - start[lo:lo + PAIR_CHUNK], 0)
+            a = np.repeat(np.arange(lo, lo + len(counts)), counts)
+            b = np.repeat(start[lo:lo + PAIR_CHUNK] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            a, b = order[a], order[b]
+            d = points[a] - points[b]
+            close = (d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1] <= radius * radius) & (image[a] != image[b])
+            first.append(a[close])
+            second.append(b[close])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def connected_components(n, first, second):
+    """
+    Label the connected components of a graph given as an edge list
+    Minimum-label propagation with pointer jumping, so chains collapse in a logarithmic number of rounds.
+    return: (n,) component label of each node (the smallest node index of its component)
+    """
+    parent = np.arange(n)
+    while True:
+        root_a, root_b = parent[first], parent[second]
+        if np.array_equal(root_a, root_b):
+            return parent
+        low = np.minimum(root_a, root_b)
+        np.minimum.at(parent, root_a, low)
+        np.minimum.at(parent, root_b, low)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+
+
+def mutual_nearest(points, image, first, second):
+    """
+    Keep the pairs whose detections are each other's nearest detection in the other's image
+    Every detection keeps at most one pair per other image, so dense rows of plants are not chained together.
+    return: (K,) and (K,) kept pairs, (K,) their distances
+    """
+    distance = np.hypot(*(points[first] - points[second]).T)
+    num_images = image.max() + 1
+    # both directions of every pair, grouped by (detection, image of the other detection) with the nearest first
+    a, b, d = np.r_[first, second], np.r_[second, first], np.r_[distance, distance]
+    group = a * num_images + image[b]
+    order = np.lexsort((d, group))
+    best = order[np.r_[True, group[order][1:] != group[order][:-1]]]
+    nearest = np.zeros(len(a), dtype=bool)
+    nearest[best] = True
+    kept = nearest[:len(first)] & nearest[len(first):]
+    return first[kept], second[kept], distance[kept]
+
+
+def split_repeats(n, image, first, second, distance):
+    """
+    Connected components in which no image appears twice
+    A component holding two detections of the same image loses its longest pair until none is left.
+    return: (n,) component label of each node
+    """
+    num_images = image.max() + 1
+    while True:
+        labels = connected_components(n, first, second)
+        members, repeats = np.unique(labels * num_images + image, return_counts=True)
+        split = np.unique(members[repeats > 1] // num_images)
+        if len(split) == 0:
+            return labels
+        edges = np.flatnonzero(np.isin(labels[first], split))
+        # longest pair of every component to split
+        order = edges[np.lexsort((-distance[edges], labels[first][edges]))]
+        component = labels[first][order]
+        drop = order[np.r_[True, component[1:] != component[:-1]]]
+        keep = np.ones(len(first), dtype=bool)
+        keep[drop] = False
+        first, second, distance = first[keep], second[keep], distance[keep]
+
+
+def deduplicate(points, image, radius=RADIUS):
+    """
+    Merge detections of the same plant seen from several images into one point
+    Detections of different images within radius of each other that are mutual nearest neighbours are linked,
+    linked detections form one cluster with at most one detection per image, whose point is the mean of its members.
+    param points: (N,2) detections in meters, origin frame
+    param image: (N,) index of the image of each detection
+    return: (M,2) merged points, (N,) cluster of each detection, (M,) number of detections in each cluster
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros((0, 2)), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    with profiling.span("dedup", points=len(points)):
+        image = np.asarray(image)
+        first, second, distance = mutual_nearest(points, image, *neighbour_pairs(points, image, radius))
+        labels = split_repeats(len(points), image, first, second, distance)
+        _, cluster = np.unique(labels, return_inverse=True)
+        support = np.bincount(cluster)
+        merged = np.stack([np.bincount(cluster, weights=points[:, 0]), np.bincount(cluster, weights=points[:, 1])], axis=1) / support[:, None]
+    return merged, cluster, support
+
+
+def brute_force_pairs(points, image, radius):
+    """All cross-image pairs within radius by comparing every two detections, for checking neighbour_pairs."""
+    d = np.hypot(*(points[:, None] - points[None]).transpose(2, 0, 1))
+    close = (d <= radius) & (image[:, None] != image[None]) & np.triu(np.ones(d.shape, dtype=bool), 1)
+    return set(zip(*np.nonzero(close)))
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    # correctness of the spatial hash against the pairwise comparison
+    for n in [50, 500, 3000]:
+        points, image = rng.uniform(0, np.sqrt(n) * 0.3, (n, 2)), rng.integers(0, 6, n)
+        first, second = neighbour_pairs(points, image, RADIUS)
+        found = set(zip(np.minimum(first, second).tolist(), np.maximum(first, second).tolist()))
+        print(f"{n} points: {len(first)} pairs, identical: {found == brute_force_pairs(points, image, RADIUS)}")
+
+    # dense patch: plants closer than the radius, each seen by two overlapping images with position jitter
+    plants = np.stack(np.meshgrid(np.arange(10) * 0.12, np.arange(10) * 0.12), axis=-1).reshape(-1, 2)
+    points = np.concatenate([plants + rng.uniform(-0.03, 0.03, plants.shape) for _ in range(2)])
+    image = np.repeat([0, 1], len(plants))
+    merged, cluster, support = deduplicate(points, image)
+    per_image = np.unique(cluster * 2 + image, return_counts=True)[1]
+    print(f"dense patch: {len(plants)} plants, {len(merged)} merged, largest support {support.max()}, "
+          f"one detection per image: {bool((per_image == 1).all())}")
+
+    # benchmark
+    for n in [100_000, 1_000_000]:
+        points, image = rng.uniform(0, np.sqrt(n) * 0.8, (n, 2)), rng.integers(0, 400, n)
+        start = time.perf_counter()
+        merged, cluster, support = deduplicate(points, image)
+        print(f"{n} points: {len(merged)} merged in {time.perf_counter() - start:.3f} s")
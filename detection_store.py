@@ -0,0 +1,98 @@
+import os, numpy as np
+
+# per-flight store: one .npy file per column, memory-mapped on open
+# rows of the same image are contiguous, image_ptr[i]:image_ptr[i+1] are the rows of names[i]
+STORE_DIR = "detections"
+PARTS_DIR = "parts"
+COLUMNS = ("corners", "conf", "tile", "image_id", "image_ptr", "names")
+
+
+def part_path(output_path, image_name):
+    """Per-image part file written next to the labels, consolidated into the store by build_store."""
+    return os.path.join(output_path, STORE_DIR, PARTS_DIR, os.path.basename(image_name).split(".")[0] + ".npz")
+
+
+def write_part(output_path, image_name, corners, conf, tile):
+    """
+    Store the kept detections of one image
+    param corners: (N,4,2) normalized corner points
+    param conf: (N,) confidences
+    param tile: (N,) index of the tile that produced each box
+    """
+    path = part_path(output_path, image_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, name=np.array(os.path.basename(image_name)), corners=np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2),
+                 conf=np.asarray(conf, dtype=np.float32), tile=np.asarray(tile, dtype=np.int32))
+    os.replace(tmp_path, path)
+
+
+def build_store(output_path):
+    """
+    Consolidate the per-image parts of a run into the columnar store of the flight
+    A run that wrote no parts (no valid image) gets an empty store.
+    return: path of the store directory
+    """
+    store_path = os.path.join(output_path, STORE_DIR)
+    parts_path = os.path.join(store_path, PARTS_DIR)
+    os.makedirs(store_path, exist_ok=True)
+    parts = sorted(f for f in os.listdir(parts_path) if f.endswith(".npz")) if os.path.isdir(parts_path) else []
+    names, corners, conf, tile = [], [], [], []
+    for part in parts:
+        with np.load(os.path.join(parts_path, part)) as data:
+            names.append(str(data["name"]))
+            corners.append(data["corners"])
+            conf.append(data["conf"])
+            tile.append(data["tile"])
+
+    counts = np.array([len(c) for c in conf], dtype=np.int64)
+    columns = {
+        "corners": np.concatenate(corners) if corners else np.zeros((0, 4, 2), np.float32),
+        "conf": np.concatenate(conf) if conf else np.zeros(0, np.float32),
+        "tile": np.concatenate(tile) if tile else np.zeros(0, np.int32),
+        "image_id": np.repeat(np.arange(len(names), dtype=np.int32), counts),
+        "image_ptr": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        "names": np.array(names, dtype=str),
+    }
+    for name, column in columns.items():
+        np.save(os.path.join(store_path, name + ".npy"), column)
+    return store_path
+
+
+class DetectionStore:
+    """
+    Read side of the columnar store, every column is memory-mapped so per-image access is a zero-copy slice
+    store["DJI_..._Waypoint1.JPG"]["corners"] -> (N,4,2) normalized corner points of that image
+    """
+
+    def __init__(self, store_path):
+        self.path = store_path
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(store_path, name + ".npy"), mmap_mode=None if name == "names" else "r"))
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, image_name):
+        return os.path.basename(image_name) in self._index
+
+    def rows(self, image_name):
+        """Slice of the rows of an image."""
+        i = self._index[os.path.basename(image_name)]
+        return slice(self.image_ptr[i], self.image_ptr[i + 1])
+
+    def __getitem__(self, image_name):
+        rows = self.rows(image_name)
+        return {"corners": self.corners[rows], "conf": self.conf[rows], "tile": self.tile[rows]}
+
+
+def export_labels(store_path, label_dir):
+    """Write YOLO OBB text labels (class x1 y1 ... x4 y4, normalized) for every image of a store."""
+    store = DetectionStore(store_path)
+    os.makedirs(label_dir, exist_ok=True)
+    for name in store.names:
+        with open(os.path.join(label_dir, name.split(".")[0] + ".txt"), "w") as f:
+            for box in store[name]["corners"]:
+                f.write("0 " + " ".join(f"{pt[0]} {pt[1]}" for pt in box) + "\n")
@@ -0,0 +1,118 @@
+import os, numpy as np, pyexiv2
+from concurrent.futures import ProcessPoolExecutor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# raw values as stored by the drone, every module applies its own conversion (radians, +1 m altitude, ...)
+METADATA_DTYPE = np.dtype([
+    ('lat', np.float64),       # Xmp.drone-dji.GpsLatitude
+    ('lon', np.float64),       # Xmp.drone-dji.GpsLongitude
+    ('yaw', np.float64),       # Xmp.drone-dji.FlightYawDegree
+    ('pitch', np.float64),     # Xmp.drone-dji.GimbalPitchDegree
+    ('altitude', np.float64),  # Xmp.drone-dji.RelativeAltitude
+    ('width', np.float64),     # Exif.Photo.PixelXDimension
+    ('height', np.float64),    # Exif.Photo.PixelYDimension
+])
+
+
+def read_image_metadata(img_path):
+    """
+    Read the pose and size of one image, opening it once and parsing XMP and EXIF once each
+    param img_path: path to the image
+    return: tuple in METADATA_DTYPE field order
+    """
+    img = pyexiv2.Image(img_path)
+    try:
+        xmp = img.read_xmp()
+        exif = img.read_exif()
+    finally:
+        img.close()
+    return (float(xmp['Xmp.drone-dji.GpsLatitude']), float(xmp['Xmp.drone-dji.GpsLongitude']),
+            float(xmp['Xmp.drone-dji.FlightYawDegree']), float(xmp['Xmp.drone-dji.GimbalPitchDegree']),
+            float(xmp['Xmp.drone-dji.RelativeAltitude']),
+            float(exif['Exif.Photo.PixelXDimension']), float(exif['Exif.Photo.PixelYDimension']))
+
+
+def cache_path(img_dir):
+    """Metadata cache file of a flight folder, stored next to the folder."""
+    img_dir = os.path.normpath(img_dir)
+    return os.path.join(os.path.dirname(img_dir), f".{os.path.basename(img_dir)}_metadata.npz")
+
+
+def _file_stamps(img_dir, names):
+    stats = [os.stat(os.path.join(img_dir, name)) for name in names]
+    return np.array([s.st_size for s in stats], dtype=np.int64), np.array([s.st_mtime_ns for s in stats], dtype=np.int64)
+
+
+class FlightMetadata:
+    """
+    Pose and size of every image of a flight, read once and kept in a structured numpy array
+    Rows are looked up by image file name: metadata["DJI_..._Waypoint1.JPG"]["lat"].
+    """
+
+    def __init__(self, names, records):
+        self.names = np.asarray(names, dtype=str)
+        self.records = records
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, img_path):
+        return os.path.basename(img_path) in self._index
+
+    def __getitem__(self, img_path):
+        """Record of an image, given its file name or a path to it."""
+        return self.records[self._index[os.path.basename(img_path)]]
+
+    @classmethod
+    def load(cls, img_dir, workers=None, use_cache=True):
+        """
+        Build the index of a flight folder, reading only images that are new or changed since the cached index
+        param img_dir: flight folder
+        param workers: number of reader processes (None: one per core)
+        param use_cache: read and write the on-disk cache next to the folder
+        """
+        names = sorted(f for f in os.listdir(img_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+        sizes, mtimes = _file_stamps(img_dir, names)
+        records = np.zeros(len(names), dtype=METADATA_DTYPE)
+
+        cached = {}
+        path = cache_path(img_dir)
+        if use_cache and os.path.exists(path):
+            with np.load(path) as data:
+                cached = {name: (size, mtime, record) for name, size, mtime, record
+                          in zip(data["names"], data["sizes"], data["mtimes"], data["records"])}
+
+        missing = []
+        for i, (name, size, mtime) in enumerate(zip(names, sizes, mtimes)):
+            entry = cached.get(name)
+            if entry is not None and entry[0] == size and entry[1] == mtime:
+                records[i] = entry[2]
+            else:
+                missing.append(i)
+
+        if missing:
+            paths = [os.path.join(img_dir, names[i]) for i in missing]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for i, values in zip(missing, executor.map(read_image_metadata, paths, chunksize=16)):
+                    records[i] = values
+            if use_cache:
+                # written aside and renamed into place, so concurrent readers never load a partial file
+                tmp_path = path + f".{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, names=np.asarray(names, dtype=str), sizes=sizes, mtimes=mtimes, records=records)
+                os.replace(tmp_path, path)
+        return cls(names, records)
+
+
+def lookup(img_path, metadata=None):
+    """
+    Record of an image, from the flight index when it contains the image, read from the file otherwise
+    param img_path: path to the image
+    param metadata: FlightMetadata or None
+    return: record with the METADATA_DTYPE fields
+    """
+    if metadata is not None and img_path in metadata:
+        return metadata[img_path]
+    return np.array(read_image_metadata(img_path), dtype=METADATA_DTYPE)[()]
@@ -1,6 +1,6 @@
 import numpy as np
-import os
-import pyexiv2
+import os, warnings
+import flight_metadata
 
 SENSOR_FOV_VERTICAL = np.radians(55.072)
 SENSOR_FOV_HORIZONTAL = np.radians(69.72)
@@ -79,24 +79,19 @@ def get_drone_coor(lat1, lon1, lat2, lon2, yaw_angle):
     return drone_x, drone_y
 
 
-def get_detections_coor(img_path, detections_path):
+def get_detections_coor(img_path, detections_path, metadata=None):
     """
     Get the relative Cartesian coordinates of all detections in an image
     param img_path: path to the image
     param detections_path: path to the detection txt file
+    param metadata: FlightMetadata index of the flight, the image file is read when omitted
     return: list of (x,y) coordinates in meters relative to drone position
     """
-    img = pyexiv2.Image(img_path)
-    yaw = np.radians(90 - float(img.read_xmp()['Xmp.drone-dji.FlightYawDegree']))
-    pitch = np.radians(float(img.read_xmp()['Xmp.drone-dji.GimbalPitchDegree']))
-    # print("pitch:", pitch)
-    altitude = float(img.read_xmp()['Xmp.drone-dji.RelativeAltitude']) + 1
-    # print("altitude:", altitude)
-    # print("yaw:", yaw) 
-    img_width = float(img.read_exif()['Exif.Photo.PixelXDimension'])
-    # print("img width: ", img_width)
-    img_height = float(img.read_exif()['Exif.Photo.PixelYDimension'])
-    # print("img height: ", img_height)
+    img = flight_metadata.lookup(img_path, metadata)
+    pitch = np.radians(img['pitch'])
+    altitude = img['altitude'] + 1
+    img_width = img['width']
+    img_height = img['height']
     coor_list = []
     with open(detections_path) as file:
         lines = file.read().splitlines()
@@ -125,7 +120,68 @@ def map_to_drone(detections_coor, drone_coor):
     return mapped_list
 
 
-def get_image_corners(origin_path, img_path):
+def read_labels(detections_path):
+    """
+    Parse a whole label file at once
+    param detections_path: path to the detection txt file (class x1 y1 x2 y2 x3 y3 x4 y4 per line, normalized)
+    return: (N,4,2) array of normalized corner points
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning) # empty label file
+        boxes = np.loadtxt(detections_path, usecols=range(1, 9), ndmin=2, dtype=np.float64)
+    return boxes.reshape(-1, 4, 2)
+
+
+def find_centers(boxes, width, height):
+    """
+    Array version of find_center
+    param boxes: (N,4,2) array of normalized corner points
+    return: (N,2) array of box centers in pixels, origin at the center of the image
+    """
+    # same summation order as find_center so results are identical
+    centers = (boxes[:, 0] + boxes[:, 1] + boxes[:, 2] + boxes[:, 3]) / 4
+    x = centers[:, 0] * width - width / 2
+    y = -(centers[:, 1] * height) + height / 2
+    return np.stack([x, y], axis=1)
+
+
+def find_point_projections(points, img_width, img_height, drone_height, pitch):
+    """
+    Array version of find_point_projection
+    param points: (N,2) array of pixel coordinates, origin at the center of the image
+    return: (N,2) array of x_distance, y_distance in meters relative to drone position
+    """
+    x_distance, y_distance = find_point_projection((points[:, 0], points[:, 1]), img_width, img_height, drone_height, pitch)
+    return np.stack([x_distance, y_distance], axis=1)
+
+
+def map_to_drone_array(detections_coor, drone_coor):
+    """
+    Array version of map_to_drone
+    param detections_coor: (N,2) array of coordinates in meters relative to drone position
+    param drone_coor: (x,y) coordinate of the drone in relative coordinate system
+    return: (N,2) array of coordinates in meters in relative coordinate system
+    """
+    return np.asarray(detections_coor, dtype=np.float64).reshape(-1, 2) + np.asarray(drone_coor, dtype=np.float64)
+
+
+def get_detections_coor_array(img_path, detections, metadata=None):
+    """
+    Array version of get_detections_coor
+    param img_path: path to the image
+    param detections: path to the detection txt file, or (N,4,2) array of normalized corner points (e.g. a detection store slice)
+    param metadata: FlightMetadata index of the flight, the image file is read when omitted
+    return: (N,2) array of coordinates in meters relative to drone position
+    """
+    img = flight_metadata.lookup(img_path, metadata)
+    pitch = np.radians(img['pitch'])
+    altitude = img['altitude'] + 1
+    boxes = read_labels(detections) if isinstance(detections, (str, os.PathLike)) else np.asarray(detections, dtype=np.float64)
+    centers = find_centers(boxes, img['width'], img['height'])
+    return find_point_projections(centers, img['width'], img['height'], altitude, pitch)
+
+
+def get_image_corners(origin_path, img_path, metadata=None):
     """
     Computes the projected ground coordinates of the four image corners
 
@@ -140,6 +196,8 @@ def get_image_corners(origin_path, img_path):
     img_path : str
         File path to the image whose corner coordinates will be projected and
         mapped.
+    metadata : FlightMetadata, optional
+        Index of the flight; the image files are read when it is omitted.
 
     Returns
     -------
@@ -148,18 +206,18 @@ def get_image_corners(origin_path, img_path):
         Top-Left, Top-Right, Bottom-Right, Bottom-Left.
         Units are in meters relative to the origin image's position.
     """
-    origin = pyexiv2.Image(origin_path)
-    img = pyexiv2.Image(img_path)
+    origin = flight_metadata.lookup(origin_path, metadata)
+    img = flight_metadata.lookup(img_path, metadata)
     corners = [] # stored in (x, y) from TL, TR, BR, BL order
-    LAT1 = float(origin.read_xmp()['Xmp.drone-dji.GpsLatitude'])
-    LON1 = float(origin.read_xmp()['Xmp.drone-dji.GpsLongitude'])
-    lat2 = float(img.read_xmp()['Xmp.drone-dji.GpsLatitude'])
-    lon2 = float(img.read_xmp()['Xmp.drone-dji.GpsLongitude'])   
-    yaw = np.radians(90 - float(img.read_xmp()['Xmp.drone-dji.FlightYawDegree']))
-    altitude = float(img.read_xmp()['Xmp.drone-dji.RelativeAltitude']) + 1  
-    pitch = np.radians(float(img.read_xmp()['Xmp.drone-dji.GimbalPitchDegree']))    
-    img_width = float(img.read_exif()['Exif.Photo.PixelXDimension'])
-    img_height = float(img.read_exif()['Exif.Photo.PixelYDimension'])
+    LAT1 = origin['lat']
+    LON1 = origin['lon']
+    lat2 = img['lat']
+    lon2 = img['lon']
+    yaw = np.radians(90 - img['yaw'])
+    altitude = img['altitude'] + 1
+    pitch = np.radians(img['pitch'])
+    img_width = img['width']
+    img_height = img['height']
 
     # Top-left
     x, y = find_point_projection((-img_width/2,img_height/2), img_width, img_height, altitude, pitch)
@@ -178,18 +236,28 @@ def get_image_corners(origin_path, img_path):
     mapped_corners = map_to_drone(corners, drone_coor)
     return mapped_corners
 
-def georef(origin_path, img_path, label_path):
-    detections_coor = get_detections_coor(img_path, label_path)
-    LAT1 = float(pyexiv2.Image(origin_path).read_xmp()['Xmp.drone-dji.GpsLatitude'])
-    LON1 = float(pyexiv2.Image(origin_path).read_xmp()['Xmp.drone-dji.GpsLongitude'])
-    lat2 = float(pyexiv2.Image(img_path).read_xmp()['Xmp.drone-dji.GpsLatitude'])
-    lon2 = float(pyexiv2.Image(img_path).read_xmp()['Xmp.drone-dji.GpsLongitude'])
-    yaw = np.radians(90 - float(pyexiv2.Image(origin_path).read_xmp()['Xmp.drone-dji.FlightYawDegree']))
+def georef(origin_path, img_path, label_path, metadata=None):
+    origin = flight_metadata.lookup(origin_path, metadata)
+    img = flight_metadata.lookup(img_path, metadata)
+    detections_coor = get_detections_coor(img_path, label_path, metadata)
+    LAT1 = origin['lat']
+    LON1 = origin['lon']
+    lat2 = img['lat']
+    lon2 = img['lon']
+    yaw = np.radians(90 - origin['yaw'])
     drone_coor = get_drone_coor(LAT1, LON1, lat2, lon2, yaw)
     mapped_coor = map_to_drone(detections_coor, drone_coor)
-    pyexiv2.Image(img_path).close()
-    pyexiv2.Image(origin_path).close()
     return mapped_coor
 
-
-
+def georef_array(origin_path, img_path, detections, metadata=None):
+    """
+    Array version of georef
+    param detections: path to the label file, or (N,4,2) array of normalized corner points
+    return: (N,2) array of detection coordinates in meters relative to the origin image's position
+    """
+    origin = flight_metadata.lookup(origin_path, metadata)
+    img = flight_metadata.lookup(img_path, metadata)
+    detections_coor = get_detections_coor_array(img_path, detections, metadata)
+    yaw = np.radians(90 - origin['yaw'])
+    drone_coor = get_drone_coor(origin['lat'], origin['lon'], img['lat'], img['lon'], yaw)
+    return map_to_drone_array(detections_coor, drone_coor)
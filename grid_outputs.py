@@ -0,0 +1,71 @@
+import numpy as np
+import pixel_to_gps, profiling
+
+# georeferenced raster and columnar outputs of a density map, rasterio and pyarrow are only needed when they are written
+# the raster CRS is an equirectangular projection centered on the origin image with the sphere of meters_to_gps,
+# so raster coordinates are exactly the east / north offsets that densitymap converts to GPS for the CSVs
+NODATA = -1.0 # cells that are not part of the map (no image, or an image without detections)
+OVERVIEW_FACTORS = (2, 4, 8, 16)
+BLOCK_SIZE = 256
+
+
+def crs_proj4(origin_gps, shift_vector=(0.0, 0.0)):
+    """Equirectangular CRS of a flight: meters east / north of the origin image, the shift vector moves the projection origin."""
+    lat, lon = float(origin_gps[0]), float(origin_gps[1])
+    return (f"+proj=eqc +lat_ts={lat!r} +lat_0={lat + float(shift_vector[0])!r} +lon_0={lon + float(shift_vector[1])!r} "
+            f"+x_0=0 +y_0=0 +R={pixel_to_gps.R_EARTH!r} +units=m +no_defs")
+
+
+def geotransform(density_map, yaw):
+    """
+    Affine transform from (col, row) pixel corners to the CRS of crs_proj4
+    Row 0 is the forward-most row of the grid, so the raster is the grid flipped vertically and rotated by the origin yaw.
+    return: (a, b, c, d, e, f) with east = a * col + b * row + c, north = d * col + e * row + f
+    """
+    x0, y_top = density_map.x_lines[0], density_map.y_lines[-1]
+    step_x, step_y = density_map.x_lines[1] - density_map.x_lines[0], density_map.y_lines[1] - density_map.y_lines[0]
+    sin, cos = np.sin(yaw), np.cos(yaw)
+    # origin frame (x right, y forward) to east / north, as in meters_to_gps
+    return (step_x * sin, -step_y * cos, x0 * sin + y_top * cos,
+            -step_x * cos, -step_y * sin, -x0 * cos + y_top * sin)
+
+
+def write_geotiff(density_map, origin_gps, yaw, shift_vector, path, tiled=False):
+    """
+    Write the density (detections per square meter) as a single-band float32 GeoTIFF, cells that are not part of the map are NODATA
+    The density is computed from the counts, not taken from the integer density_grid, so coarse pyramid levels keep their fractions.
+    param tiled: write BLOCK_SIZE tiles with deflate compression and averaged overviews, for large fields in QGIS
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import Affine
+
+    density = density_map.counts / density_map.side_length_meters**2
+    band = np.where(density_map.filled, density, NODATA).astype(np.float32)[::-1]
+    profile = {"driver": "GTiff", "height": band.shape[0], "width": band.shape[1], "count": 1, "dtype": "float32",
+               "crs": crs_proj4(origin_gps, shift_vector), "transform": Affine(*geotransform(density_map, yaw)), "nodata": NODATA}
+    if tiled:
+        profile.update(tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE, compress="deflate")
+    with profiling.span("geotiff_write", cells=band.size), rasterio.open(path, "w", **profile) as dst:
+        dst.write(band, 1)
+        dst.update_tags(units="detections per square meter", side_length_meters=density_map.side_length_meters)
+        if tiled:
+            factors = [f for f in OVERVIEW_FACTORS if f < max(band.shape)]
+            if factors:
+                dst.build_overviews(factors, Resampling.average)
+
+
+def write_parquet(columns, img_names, side_length_meters, crs, path):
+    """
+    Write every filled cell as one row of a Parquet table, the image column is dictionary-encoded file names
+    param columns: densitymap.cell_columns of the map
+    param crs: crs_proj4 of the flight, stored in the table metadata with the side length
+    """
+    import pyarrow as pa, pyarrow.parquet as pq
+
+    with profiling.span("parquet_write", cells=len(columns["row"])):
+        arrays = {name: pa.array(values) for name, values in columns.items() if name != "image"}
+        arrays["image"] = pa.DictionaryArray.from_arrays(columns["image"], pa.array(img_names, type=pa.string()))
+        table = pa.table(arrays).select(list(columns))
+        table = table.replace_schema_metadata({"side_length_meters": str(side_length_meters), "crs": crs})
+        pq.write_table(table, path, compression="zstd")
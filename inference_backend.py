@@ -0,0 +1,249 @@
+import os, shutil, time, json, numpy as np, cv2, shapely
+import inference_cache
+
+# torch: ultralytics eager PyTorch on the .pt weights
+# onnx / openvino: the weights are exported once per weights version and the artifact is cached next to the weights,
+# tiles still go through ultralytics (preprocessing, OBB decoding, rotated NMS), so result.obb is the same structure
+BACKENDS = ("torch", "onnx", "openvino")
+EXPORT_DIR = ".exports"
+ARTIFACTS = {"onnx": "model.onnx", "openvino": "model_openvino_model"}
+CALIBRATION_TILES = 300 # tiles written for INT8 calibration
+CALIBRATION_IMAGES = 30 # flight images the calibration tiles are taken from
+
+
+def set_threads(threads):
+    """
+    Limit the intra-op threads of every CPU runtime in this process (None: runtime defaults)
+    Set before the runtimes create their thread pools, i.e. in the worker initializer.
+    """
+    if threads is None:
+        return
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    cv2.setNumThreads(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+
+def export_path(weight_path, backend, img_dim, int8=False):
+    """Cache directory of an exported model: weights content, backend, tile size and precision."""
+    import ultralytics
+    digest = inference_cache.weights_digest(weight_path)[:16]
+    name = f"{backend}{'_int8' if int8 else ''}_{img_dim}_{ultralytics.__version__}_{digest}"
+    return os.path.join(os.path.dirname(os.path.abspath(weight_path)), EXPORT_DIR, name)
+
+
+def write_calibration_set(image_paths, calib_dir, img_dim, max_tiles=CALIBRATION_TILES, max_images=CALIBRATION_IMAGES):
+    """
+    Write tiles of sample flight images as the INT8 calibration set, with the dataset yaml ultralytics expects
+    Images are sampled evenly across the flight and tiles evenly within each image, so calibration sees the whole
+    range of scenes; only the sampled images are decoded and their tiles are written before the next one is read.
+    return: path of the dataset yaml
+    """
+    import split_predict
+    sample = np.unique(np.linspace(0, len(image_paths) - 1, min(len(image_paths), max_images)).round().astype(int))
+    per_image = -(max_tiles // -len(sample))
+    os.makedirs(os.path.join(calib_dir, "images"), exist_ok=True)
+    written = 0
+    for i in sample:
+        img = split_predict.read_image(image_paths[i])
+        if img is None:
+            continue
+        # full tiles only, the calibration reader feeds them without letterboxing
+        tiles = [tile for tile in split_predict.make_tiles(img, img_dim)[0] if tile.shape[:2] == (img_dim, img_dim)]
+        step = max(1, len(tiles) // per_image)
+        for tile in tiles[::step][:min(per_image, max_tiles - written)]:
+            cv2.imwrite(os.path.join(calib_dir, "images", f"tile_{written:04d}.jpg"), tile)
+            written += 1
+
+    yaml_path = os.path.join(calib_dir, "data.yaml")
+    with open(yaml_path, "w") as f:
+        # json is valid yaml
+        json.dump({"path": os.path.abspath(calib_dir), "train": "images", "val": "images", "names": {0: "redroot"}}, f)
+    return yaml_path
+
+
+def _calibration_reader(images_dir, img_dim):
+    """onnxruntime calibration reader feeding the tiles preprocessed like ultralytics (RGB, CHW, [0, 1])."""
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class TileReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.files = iter(sorted(os.listdir(images_dir)))
+
+        def get_next(self):
+            name = next(self.files, None)
+            if name is None:
+                return None
+            tile = cv2.resize(cv2.imread(os.path.join(images_dir, name)), (img_dim, img_dim))
+            tile = np.ascontiguousarray(tile[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255
+            return {self.input_name: tile}
+    return TileReader
+
+
+def _quantize_onnx(model_path, output_path, images_dir, img_dim):
+    """Static INT8 quantization (QDQ, per-channel weights) of an ONNX model, keeping the ultralytics metadata."""
+    import onnx, onnxruntime
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+
+    input_name = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    quantize_static(model_path, output_path, _calibration_reader(images_dir, img_dim)(input_name),
+                    quant_format=QuantFormat.QDQ, per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    # stride, names, imgsz and task are read back from the metadata by ultralytics
+    source, quantized = onnx.load(model_path), onnx.load(output_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, output_path)
+
+
+def export_model(weight_path, backend, img_dim, int8=False, calibration_images=None):
+    """
+    Export the weights to an ONNX / OpenVINO artifact once, later calls return the cached artifact
+    The export runs in a temporary directory that is renamed into place, so concurrent workers never see a partial one.
+    param weight_path: path to the .pt weights
+    param backend: "onnx" or "openvino"
+    param img_dim: tile size, the exported input size (batch size is dynamic)
+    param int8: post-training INT8 quantization, calibrated on tiles of calibration_images (needed on the first export)
+    param calibration_images: list of image paths for the INT8 calibration set
+    return: path of the artifact, loadable with ultralytics.YOLO(path, task="obb")
+    """
+    if backend not in ARTIFACTS:
+        raise ValueError(f"No export for backend {backend}, expected one of {list(ARTIFACTS)}")
+    final_dir = export_path(weight_path, backend, img_dim, int8)
+    artifact = os.path.join(final_dir, ARTIFACTS[backend])
+    if os.path.exists(artifact):
+        return artifact
+    if int8 and not calibration_images:
+        raise ValueError("INT8 export needs calibration_images")
+
+    work_dir = f"{final_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    # ultralytics writes the export next to the weights it was given
+    local_weights = shutil.copy(weight_path, os.path.join(work_dir, "model.pt"))
+    data = write_calibration_set(calibration_images, os.path.join(work_dir, "calibration"), img_dim) if int8 else None
+
+    import ultralytics
+    model = ultralytics.YOLO(local_weights)
+    if backend == "onnx":
+        exported = model.export(format="onnx", imgsz=img_dim, dynamic=True, simplify=True)
+        if int8:
+            _quantize_onnx(exported, os.path.join(work_dir, "model_int8.onnx"), os.path.join(work_dir, "calibration", "images"), img_dim)
+            exported = os.path.join(work_dir, "model_int8.onnx")
+    else:
+        exported = model.export(format="openvino", imgsz=img_dim, dynamic=True, int8=int8, data=data)
+    if os.path.abspath(exported) != os.path.join(work_dir, ARTIFACTS[backend]):
+        os.replace(exported, os.path.join(work_dir, ARTIFACTS[backend]))
+
+    try:
+        os.replace(work_dir, final_dir)
+    except OSError:
+        # another process finished the same export first
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return artifact
+
+
+def _apply_runtime_threads(model, artifact, backend, threads, img_dim):
+    """
+    Rebuild the ONNX Runtime session / OpenVINO compiled model of a loaded ultralytics model with a fixed thread count
+    ultralytics creates them with runtime defaults on the first predict, so a warm-up tile is run first.
+    """
+    model.predict(np.full((img_dim, img_dim, 3), 114, dtype=np.uint8), imgsz=img_dim, verbose=False)
+    runtime = model.predictor.model
+    if backend == "onnx":
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        runtime.session = onnxruntime.InferenceSession(artifact, options, providers=["CPUExecutionProvider"])
+    else:
+        import openvino
+        core = openvino.Core()
+        xml = next(f for f in os.listdir(artifact) if f.endswith(".xml"))
+        runtime.ov_compiled_model = core.compile_model(core.read_model(os.path.join(artifact, xml)), device_name="CPU",
+                                                       config={"INFERENCE_NUM_THREADS": threads, "PERFORMANCE_HINT": "LATENCY"})
+
+
+def load_model(weight_path, backend="torch", img_dim=640, threads=None, int8=False, calibration_images=None):
+    """
+    Load the detector on the selected backend
+    param backend: one of BACKENDS
+    param threads: intra-op threads of the runtime (None: runtime defaults)
+    param int8: use the INT8 artifact (onnx / openvino)
+    return: ultralytics.YOLO model, used through model.predict like the PyTorch one
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    # ultralytics is imported here, not at module level, so the tiling and merging code of split_predict works without it
+    import ultralytics
+    set_threads(threads)
+    if backend == "torch":
+        return ultralytics.YOLO(weight_path)
+    artifact = export_model(weight_path, backend, img_dim, int8, calibration_images)
+    model = ultralytics.YOLO(artifact, task="obb")
+    if threads is not None:
+        _apply_runtime_threads(model, artifact, backend, threads, img_dim)
+    return model
+
+
+def detection_agreement(reference, candidate, iou_threshold=0.5):
+    """
+    Share of detections two backends agree on, matching boxes of the same tile greedily by IoU
+    param reference, candidate: ultralytics results of the same tiles
+    return: (recall of the reference boxes, precision of the candidate boxes)
+    """
+    import split_predict
+    matched, ref_total, cand_total = 0, 0, 0
+    for ref_result, cand_result in zip(reference, candidate):
+        ref_boxes = split_predict.raw_detections([ref_result])[0]
+        cand_boxes = split_predict.raw_detections([cand_result])[0]
+        ref_total, cand_total = ref_total + len(ref_boxes), cand_total + len(cand_boxes)
+        if len(ref_boxes) == 0 or len(cand_boxes) == 0:
+            continue
+        ref_polys, cand_polys = shapely.polygons(ref_boxes)[:, None], shapely.polygons(cand_boxes)[None, :]
+        inter = shapely.area(shapely.intersection(ref_polys, cand_polys))
+        iou = inter / (shapely.area(ref_polys) + shapely.area(cand_polys) - inter)
+        for i in range(len(ref_boxes)):
+            j = np.argmax(iou[i])
+            if iou[i, j] >= iou_threshold:
+                matched += 1
+                iou[:, j] = 0 # each candidate box matches once
+    return matched / max(ref_total, 1), matched / max(cand_total, 1)
+
+
+if __name__ == "__main__":
+    import split_predict
+
+    # tiles/s of every backend on tiles of a few flight images, and agreement with the PyTorch detections
+    parent_directory = "./"
+    image_folder_dir = "DJI_202508081433_021_PineIslandbog5H3m5x3photo/"
+    weight_path = "best.pt"
+    img_dim, batchsize, iou_thresh, conf_thresh = 640, 8, 0.5, 0.35
+    threads = os.cpu_count()
+    sample_images = 4
+    candidates = [("onnx", False), ("openvino", False), ("openvino", True), ("onnx", True)]
+
+    image_dir = os.path.join(parent_directory, image_folder_dir)
+    image_paths = [os.path.join(image_dir, f) for f in sorted(os.listdir(image_dir)) if f.lower().endswith(".jpg")]
+    sample = image_paths[:: max(1, len(image_paths) // sample_images)][:sample_images]
+    tiles = [tile for path in sample for tile in split_predict.make_tiles(split_predict.read_image(path), img_dim)[0]]
+    weights = os.path.join(parent_directory, weight_path)
+
+    def run(backend, int8):
+        model = load_model(weights, backend, img_dim, threads, int8, calibration_images=image_paths)
+        split_predict.predict_tiles(model, tiles[:batchsize], img_dim, iou_thresh, conf_thresh, batchsize) # warm-up
+        start = time.perf_counter()
+        results = split_predict.predict_tiles(model, tiles, img_dim, iou_thresh, conf_thresh, batchsize)
+        return results, len(tiles) / (time.perf_counter() - start)
+
+    reference, reference_speed = run("torch", False)
+    print(f"{'torch':>14}: {reference_speed:.1f} tiles/s")
+    for backend, int8 in candidates:
+        try:
+            results, speed = run(backend, int8)
+        except ImportError as e:
+            print(f"{backend + (' int8' if int8 else ''):>14}: skipped ({e})")
+            continue
+        recall, precision = detection_agreement(reference, results)
+        print(f"{backend + (' int8' if int8 else ''):>14}: {speed:.1f} tiles/s ({speed / reference_speed:.2f}x), "
+              f"recall {recall:.3f}, precision {precision:.3f} against torch")
@@ -0,0 +1,75 @@
+import os, hashlib, json, numpy as np
+from functools import lru_cache
+
+# the model is run once at these permissive thresholds and the raw tile outputs are cached,
+# later runs can use any conf_thresh >= CACHE_CONF without inference: no box reaches CACHE_IOU and no tile has more
+# candidates than CACHE_MAX_DET (ultralytics' max_nms), so the cache holds every candidate the model's NMS would see
+# and split_predict replays that NMS at the run's own iou_thresh
+CACHE_CONF = 0.05
+CACHE_IOU = 1.0
+CACHE_MAX_DET = 30000
+
+
+def file_digest(path):
+    """sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _weights_digest(path, size, mtime_ns):
+    return file_digest(path)
+
+
+def weights_digest(weight_path):
+    """sha256 of the weight file, computed once per process and weight file version."""
+    stat = os.stat(weight_path)
+    return _weights_digest(os.path.abspath(weight_path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(image_path, weight_path, img_dim, decode_reduction, backend="torch", int8=False, min_vegetation=None):
+    """
+    Key of an image's raw detections: image content, weights content, tile size, decode scale and cache thresholds,
+    plus the inference backend and the vegetation filter threshold when they are not the defaults
+    return: hex digest
+    """
+    key = {"image": file_digest(image_path), "weights": weights_digest(weight_path), "img_dim": img_dim,
+           "decode_reduction": decode_reduction, "conf": CACHE_CONF, "iou": CACHE_IOU, "max_det": CACHE_MAX_DET}
+    # only added when set, so entries written with the defaults keep their keys
+    if backend != "torch" or int8:
+        key.update(backend=backend, int8=int8)
+    if min_vegetation is not None:
+        key.update(min_vegetation=min_vegetation)
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + ".npz")
+
+
+def load(cache_dir, key):
+    """
+    Raw detections of a cached image
+    return: dict with boxes (N,4,2) tile-local corners, conf (N,), tile (N,) tile index, offsets (T,2), shape (height, width),
+            or None on a cache miss
+    """
+    path = _entry_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save(cache_dir, key, boxes, conf, tile, offsets, shape):
+    """Store the raw detections of an image; the entry appears atomically so a crash never leaves a partial file."""
+    path = _entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, boxes=np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2), conf=np.asarray(conf, dtype=np.float32),
+                 tile=np.asarray(tile, dtype=np.int32), offsets=np.asarray(offsets, dtype=np.int32).reshape(-1, 2),
+                 shape=np.asarray(shape, dtype=np.int32))
+    os.replace(tmp_path, path)
@@ -0,0 +1,65 @@
+# correctness check and benchmark of nms_module against the pairwise reference implementation
+import time, numpy as np
+from shapely import Polygon
+import nms_module
+
+
+def nms_reference(boxes, conf_threshold, iou_threshold):
+    """Pairwise O(n^2) implementation of nms, kept as the reference for correctness checks."""
+
+    # discard box with conf < threshold
+    mask = boxes['conf'] >= conf_threshold
+    boxes = boxes[mask]
+    # sort by conf
+    boxes.sort(order='conf')  # ascending order
+    boxes = boxes[::-1]  # reverse
+
+    # discard if iou > threshold
+    final_boxes = []
+    polygons = [Polygon(box) for box in boxes['box']]
+    idx_list = list(range(len(polygons)))
+    while idx_list:
+        anchor_idx = idx_list.pop(0)
+        final_boxes.append(boxes[anchor_idx]['box'])
+        remaining_idx = []
+        remaining_idx = [idx for idx in idx_list if nms_module.iou(polygons[anchor_idx], polygons[idx]) < iou_threshold]
+        idx_list = remaining_idx
+    return final_boxes
+
+
+def random_boxes(n, extent, seed=0):
+    """
+    Generate n random rotated boxes in an extent x extent pixel area, as the structured array used by nms_module.nms
+    Box sizes are in the range of redroot detections (20-60 px), so dense fields produce many overlaps.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, extent, size=(n, 2))
+    half = rng.uniform(10, 30, size=(n, 2))
+    theta = rng.uniform(0, np.pi, size=n)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64)
+    local = corners[None, :, :] * half[:, None, :]
+    cos, sin = np.cos(theta)[:, None], np.sin(theta)[:, None]
+    rotated = np.stack([local[..., 0] * cos - local[..., 1] * sin, local[..., 0] * sin + local[..., 1] * cos], axis=-1)
+
+    data_abstract = np.dtype([('box', np.float32, (4, 2)), ('conf', np.float32)])
+    boxes = np.zeros(n, dtype=data_abstract)
+    boxes['box'] = rotated + centers[:, None, :]
+    boxes['conf'] = rng.uniform(0, 1, size=n)
+    return boxes
+
+
+if __name__ == "__main__":
+    # correctness against the pairwise implementation
+    for n, extent in [(500, 1000), (2000, 1500), (3000, 640)]:
+        boxes = random_boxes(n, extent, seed=n)
+        expected = nms_reference(boxes.copy(), conf_threshold=0.35, iou_threshold=0.5)
+        actual = nms_module.nms(boxes.copy(), conf_threshold=0.35, iou_threshold=0.5)
+        same = len(expected) == len(actual) and all(np.array_equal(a, b) for a, b in zip(expected, actual))
+        print(f"{n} boxes: reference kept {len(expected)}, vectorized kept {len(actual)}, identical: {same}")
+
+    # benchmark
+    for n in [10_000, 100_000]:
+        boxes = random_boxes(n, extent=int(np.sqrt(n) * 40), seed=1)
+        start = time.perf_counter()
+        kept = nms_module.nms(boxes, conf_threshold=0.35, iou_threshold=0.5)
+        print(f"{n} boxes: kept {len(kept)} in {time.perf_counter() - start:.3f} s")
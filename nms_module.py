@@ -1,5 +1,6 @@
-import os, cv2, numpy as np
-from shapely import Polygon, polygons
+import numpy as np
+import shapely
+from shapely import Polygon, polygons, STRtree
 
 # internal method
 def iou(box1: Polygon, box2: Polygon):
@@ -7,7 +8,107 @@ def iou(box1: Polygon, box2: Polygon):
     return box1.intersection(box2).area / box1.union(box2).area
 
 
+def sort_by_conf(boxes, conf_threshold):
+    """
+    Discard boxes with conf < conf_threshold and sort the rest by descending confidence
+    Ties are ordered exactly as in the original implementation (structured sort on conf, then reversed).
+    """
+    # discard box with conf < threshold
+    mask = boxes['conf'] >= conf_threshold
+    boxes = boxes[mask]
+    # sort by conf
+    boxes.sort(order='conf')  # ascending order
+    return boxes[::-1]  # reverse
+
+
+def suppress(polys, iou_threshold):
+    """
+    Greedy NMS over polygons already sorted by descending confidence
+    Only pairs whose envelopes intersect (STRtree query) are compared, and their IoU is computed in one vectorized call.
+    param polys: 1d array of shapely polygons
+    param iou_threshold: a box is suppressed by a kept box with higher confidence if their IoU >= iou_threshold
+    return: boolean mask of kept polygons
+    """
+    n = len(polys)
+    keep = np.ones(n, dtype=bool)
+    if n == 0:
+        return keep
+    if iou_threshold <= 0:
+        # every pair reaches the threshold, only the most confident box survives
+        keep[1:] = False
+        return keep
+
+    tree = STRtree(polys)
+    anchor, other = tree.query(polys, predicate="intersects")
+    pair = anchor < other # a box can only be suppressed by a box ranked before it
+    anchor, other = anchor[pair], other[pair]
+
+    areas = shapely.area(polys)
+    inter = shapely.area(shapely.intersection(polys[anchor], polys[other]))
+    ratio = inter / (areas[anchor] + areas[other] - inter)
+    # the overlay union can differ from a + b - inter in the last bits, settle pairs at the threshold with it
+    close = np.abs(ratio - iou_threshold) <= 1e-6
+    ratio[close] = inter[close] / shapely.area(shapely.union(polys[anchor[close]], polys[other[close]]))
+    hit = ratio >= iou_threshold
+    anchor, other = anchor[hit], other[hit]
+
+    # group suppressed boxes by anchor (csr layout) and run the greedy pass in rank order
+    order = np.argsort(anchor, kind="stable")
+    anchor, other = anchor[order], other[order]
+    anchors, starts = np.unique(anchor, return_index=True)
+    ends = np.append(starts[1:], len(anchor))
+    for idx, start, end in zip(anchors, starts, ends):
+        if keep[idx]:
+            keep[other[start:end]] = False
+    return keep
+
+
+def probiou(corners, eps=1e-7):
+    """
+    Pairwise probabilistic IoU of rotated rectangles, as ultralytics computes it for OBB NMS
+    Each box is the Gaussian of its rectangle (mean: center, covariance: (e1 e1^T + e2 e2^T) / 12 for its two side vectors),
+    the similarity is 1 - Hellinger distance of the two Gaussians. Computed in float32 like the model's NMS.
+    param corners: (N,4,2) corner points of rectangles
+    return: (N,N) similarity matrix
+    """
+    corners = np.asarray(corners, dtype=np.float32)
+    x, y = corners.mean(axis=1).T
+    e1, e2 = corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 1]
+    a = (e1[:, 0] ** 2 + e2[:, 0] ** 2) / 12
+    b = (e1[:, 1] ** 2 + e2[:, 1] ** 2) / 12
+    c = (e1[:, 0] * e1[:, 1] + e2[:, 0] * e2[:, 1]) / 12
+
+    a12, b12, c12 = a[:, None] + a[None], b[:, None] + b[None], c[:, None] + c[None]
+    dx, dy = x[:, None] - x[None], y[:, None] - y[None]
+    det = a12 * b12 - c12 ** 2
+    t1 = (a12 * dy ** 2 + b12 * dx ** 2) / (det + eps) * 0.25
+    t2 = (c12 * -dx * dy) / (det + eps) * 0.5
+    own = np.clip(a * b - c ** 2, 0, None)
+    t3 = np.log(det / (4 * np.sqrt(own[:, None] * own[None]) + eps) + eps) * 0.5
+    distance = np.clip(t1 + t2 + t3, eps, 100.0)
+    return 1 - np.sqrt(1.0 - np.exp(-distance) + eps)
+
+
+def model_nms(corners, conf, iou_threshold):
+    """
+    Per-tile NMS of the detector (ultralytics rotated NMS): boxes ranked by descending confidence, a box is dropped when
+    any box ranked before it, kept or not, reaches iou_threshold in probiou
+    return: indices of the kept boxes, by descending confidence
+    """
+    order = np.argsort(-np.asarray(conf), kind="stable")
+    if len(order) == 0:
+        return order
+    overlap = np.triu(probiou(np.asarray(corners)[order]), k=1)
+    return order[~(overlap >= iou_threshold).any(axis=0)]
+
+
 # global methods
+def nms_records(boxes, conf_threshold, iou_threshold):
+    """Same as nms, but return the kept rows of the structured array (all fields), by descending confidence."""
+    boxes = sort_by_conf(boxes, conf_threshold)
+    return boxes[suppress(polygons(boxes['box']), iou_threshold)]
+
+
 def nms(boxes, conf_threshold, iou_threshold):
     """Perform Non-Maximum Suppression (NMS) on a list of bounding boxes.
     Parameters:
@@ -17,22 +118,4 @@ def nms(boxes, conf_threshold, iou_threshold):
     Returns:
     list: A list of obbs that have been filtered by NMS.
     """
-
-    # discard box with conf < threshold
-    mask = boxes['conf'] >= conf_threshold
-    boxes = boxes[mask]
-    # sort by conf
-    boxes.sort(order='conf')  # ascending order
-    boxes = boxes[::-1]  # reverse 
-
-    # discard if iou > threshold
-    final_boxes = []
-    polygons = [Polygon(box) for box in boxes['box']]
-    idx_list = list(range(len(polygons)))
-    while idx_list:
-        anchor_idx = idx_list.pop(0)
-        final_boxes.append(boxes[anchor_idx]['box'])
-        remaining_idx = []
-        remaining_idx = [idx for idx in idx_list if iou(polygons[anchor_idx], polygons[idx]) < iou_threshold]
-        idx_list = remaining_idx
-    return final_boxes
\ No newline at end of file
+    return list(nms_records(boxes, conf_threshold, iou_threshold)['box'])
@@ -1,6 +1,5 @@
-import georef2
-import numpy as np
-import pyexiv2
+import georef2, flight_metadata
+import numpy as np, os, csv
 
 # constants for calculation
 SENSOR_FOV_VERTICAL = np.radians(55.072)
@@ -29,27 +28,73 @@ def meters_to_gps(lat_origin, lon_origin, dx, dy, yaw_angle):
 
 
 
-def get_gps(origin_path, img_path, pixel_coor):
-    origin_img = pyexiv2.Image(origin_path)
-    origin = float(origin_img.read_xmp()['Xmp.drone-dji.GpsLatitude']), float(origin_img.read_xmp()['Xmp.drone-dji.GpsLongitude'])
-    current_img = pyexiv2.Image(img_path)
-    width, height = float(current_img.read_exif()['Exif.Photo.PixelXDimension']), float(current_img.read_exif()['Exif.Photo.PixelYDimension'])
-    current = float(current_img.read_xmp()['Xmp.drone-dji.GpsLatitude']), float(current_img.read_xmp()['Xmp.drone-dji.GpsLongitude'])
-    yaw = np.radians(90 - float(current_img.read_xmp()['Xmp.drone-dji.FlightYawDegree']))
-    altitude = float(current_img.read_xmp()['Xmp.drone-dji.RelativeAltitude']) + 1
-    pitch = np.radians(float(current_img.read_xmp()['Xmp.drone-dji.GimbalPitchDegree']))
-    temp_x, temp_y = pixel_coor[0] - width/2, -pixel_coor[1] + height/2
-    pixel_coor[0], pixel_coor[1] = temp_x, temp_y
+def pixels_to_gps(origin, poses, pixels):
+    """
+    Array version of get_gps, no metadata is read
+    param origin: metadata record of the origin image (only lat and lon are used)
+    param poses: METADATA_DTYPE records of the image each pixel belongs to, (N,) or a single record shared by all pixels
+    param pixels: (N,2) pixel coordinates, origin at the top-left corner of the image
+    return: (N,2) array of lat, lon
+    """
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    width, height = poses['width'], poses['height']
+    yaw = np.radians(90 - poses['yaw'])
+    altitude = poses['altitude'] + 1
+    pitch = np.radians(poses['pitch'])
+    # change of basis: origin at center of image
+    centered = (pixels[:, 0] - width/2, -pixels[:, 1] + height/2)
 
     # Convert pixel coordinates to Cartesian coordinates relative to drone
-    pixel_cartesian = georef2.find_point_projection(pixel_coor, width, height, altitude, pitch)
+    pixel_cartesian = georef2.find_point_projection(centered, width, height, altitude, pitch)
 
     # get current drone x, y from origin in meters
-    drone_from_origin_cartesian = georef2.get_drone_coor(origin[0], origin[1], current[0], current[1], yaw)
+    drone_from_origin_cartesian = georef2.get_drone_coor(origin['lat'], origin['lon'], poses['lat'], poses['lon'], yaw)
 
-    # map the pixel_coor to drone with origin as basis, unit meter
+    # map the pixels to drone with origin as basis, unit meter
     x_meter, y_meter = pixel_cartesian[0] + drone_from_origin_cartesian[0], pixel_cartesian[1] + drone_from_origin_cartesian[1]
 
     # convert to gps
-    gps = meters_to_gps(origin[0], origin[1], x_meter, y_meter, yaw)
-    return gps
+    lat, lon = meters_to_gps(origin['lat'], origin['lon'], x_meter, y_meter, yaw)
+    return np.stack(np.broadcast_arrays(lat, lon), axis=1).reshape(-1, 2)
+
+
+def get_gps(origin_path, img_path, pixel_coor, metadata=None):
+    """GPS (lat, lon) of one pixel (x, y from the top-left corner) of an image, pixel_coor is left unchanged."""
+    origin_img = flight_metadata.lookup(origin_path, metadata)
+    current_img = flight_metadata.lookup(img_path, metadata)
+    lat, lon = pixels_to_gps(origin_img, current_img, [pixel_coor])[0]
+    return lat, lon
+
+
+def detections_to_gps(origin_path, img_names, detections, metadata):
+    """
+    GPS of the center of every detection of a flight, converted in one call
+    param img_names: image file names
+    param detections: (N_i,4,2) normalized corner points of each image (label file rows or a detection store slice)
+    param metadata: FlightMetadata of the flight
+    return: (N,) image index of each detection, (N,2) array of lat, lon
+    """
+    origin = flight_metadata.lookup(origin_path, metadata)
+    poses = np.array([metadata[name] for name in img_names], dtype=flight_metadata.METADATA_DTYPE)
+    image_index = np.repeat(np.arange(len(img_names)), [len(boxes) for boxes in detections])
+    boxes = np.concatenate([np.zeros((0, 4, 2))] + [np.asarray(boxes, dtype=np.float64).reshape(-1, 4, 2) for boxes in detections])
+    # same summation order as georef2.find_centers
+    centers = (boxes[:, 0] + boxes[:, 1] + boxes[:, 2] + boxes[:, 3]) / 4
+    pose = poses[image_index]
+    pixels = np.stack([centers[:, 0] * pose['width'], centers[:, 1] * pose['height']], axis=1)
+    return image_index, pixels_to_gps(origin, pose, pixels)
+
+
+def export_detections(origin_path, img_dir, label_dir, csv_output, shift_vector=(0.0, 0.0), metadata=None):
+    """
+    Write the GPS of every detection of a flight (label files in label_dir) as a CSV for QGIS
+    param shift_vector: (lat, lon) correction added to every point, as in densitymap.write_csv
+    """
+    metadata = metadata if metadata is not None else flight_metadata.FlightMetadata.load(img_dir)
+    img_names = [name for name in metadata.names if os.path.exists(os.path.join(label_dir, name.split(".")[0] + ".txt"))]
+    detections = [georef2.read_labels(os.path.join(label_dir, name.split(".")[0] + ".txt")) for name in img_names]
+    image_index, gps = detections_to_gps(origin_path, img_names, detections, metadata)
+    with open(csv_output, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["latitude", "longitude", "image_id"])
+        writer.writerows(zip(gps[:, 0] + shift_vector[0], gps[:, 1] + shift_vector[1], np.asarray(img_names, dtype=str)[image_index]))
@@ -0,0 +1,117 @@
+import os, json, time, glob, threading
+from contextlib import contextmanager, nullcontext
+
+# profiling is switched on by pointing this variable at a directory, worker processes inherit it from the parent
+ENV_VAR = "REDROOT_PROFILE"
+_NULL_SPAN = nullcontext()
+
+_lock = threading.Lock()
+_files = {} # pid -> open event file of this process
+
+
+def enable(profile_dir):
+    """
+    Switch profiling on for this process and for every process it starts afterwards (call before creating pools)
+    Event files of an earlier run in profile_dir are removed.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(profile_dir, "events_*.jsonl")):
+        os.remove(path)
+    for f in _files.values():
+        f.close()
+    _files.clear()
+    os.environ[ENV_VAR] = os.path.abspath(profile_dir)
+
+
+def enabled():
+    return ENV_VAR in os.environ
+
+
+def _event_file():
+    pid = os.getpid()
+    f = _files.get(pid)
+    if f is None:
+        # one file per process, re-opened after a fork so parent and child never share a handle
+        f = open(os.path.join(os.environ[ENV_VAR], f"events_{pid}.jsonl"), "a", buffering=1)
+        _files.clear()
+        _files[pid] = f
+    return f
+
+
+def record(name, start_ns, end_ns, args):
+    """Append one complete event (Chrome trace "X" phase, microseconds) to the event file of this process."""
+    event = {"name": name, "ph": "X", "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+             "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+    line = json.dumps(event) + "\n"
+    with _lock:
+        _event_file().write(line)
+
+
+@contextmanager
+def _span(name, args):
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter_ns(), args)
+
+
+def span(name, **args):
+    """
+    Time a named block: with profiling.span("decode", image=image_name): ...
+    A shared no-op context manager when profiling is off, so instrumented code pays one dict lookup.
+    param args: attached to the event, "image" is used to aggregate per image
+    """
+    if ENV_VAR not in os.environ:
+        return _NULL_SPAN
+    return _span(name, args)
+
+
+def merge(profile_dir, output_prefix=None):
+    """
+    Combine the per-process event files of a run into a Chrome trace (chrome://tracing, Perfetto) and a JSON summary
+    The summary has, for every span name, its totals overall, per worker process and per image.
+    param output_prefix: path prefix of <prefix>_trace.json and <prefix>_summary.json (default: profile_dir/profile)
+    return: summary dict
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, "events_*.jsonl"))):
+        with open(path) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda e: e["ts"])
+
+    def add(table, key, event):
+        entry = table.setdefault(key, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+        entry["count"] += 1
+        entry["total_s"] += event["dur"] / 1e6
+        entry["max_s"] = max(entry["max_s"], event["dur"] / 1e6)
+
+    spans, per_worker, per_image = {}, {}, {}
+    for event in events:
+        add(spans, event["name"], event)
+        add(per_worker.setdefault(str(event["pid"]), {}), event["name"], event)
+        if "image" in event["args"]:
+            add(per_image.setdefault(event["args"]["image"], {}), event["name"], event)
+    for table in [spans] + list(per_worker.values()) + list(per_image.values()):
+        for entry in table.values():
+            entry["mean_s"] = entry["total_s"] / entry["count"]
+            for key in ("total_s", "max_s", "mean_s"):
+                entry[key] = round(entry[key], 6)
+
+    wall = (max(e["ts"] + e["dur"] for e in events) - min(e["ts"] for e in events)) / 1e6 if events else 0.0
+    summary = {"wall_s": round(wall, 3), "processes": len(per_worker), "spans": spans, "per_worker": per_worker, "per_image": per_image}
+
+    output_prefix = output_prefix or os.path.join(profile_dir, "profile")
+    names = [{"name": "process_name", "ph": "M", "pid": int(pid), "args": {"name": f"worker {pid}"}} for pid in per_worker]
+    with open(output_prefix + "_trace.json", "w") as f:
+        json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, f)
+    with open(output_prefix + "_summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def print_summary(summary):
+    """Print the time spent in every span, heaviest first (totals are summed over processes)."""
+    print(f"Profile: {summary['wall_s']} s wall time, {summary['processes']} processes")
+    for name, entry in sorted(summary["spans"].items(), key=lambda item: -item[1]["total_s"]):
+        print(f"{name:>16}: {entry['total_s']:>10.3f} s total, {entry['count']:>7} calls, mean {entry['mean_s'] * 1000:.2f} ms")
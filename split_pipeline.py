@@ -0,0 +1,187 @@
+import os, time, threading, queue
+import split_predict, profiling
+
+_DONE = None # end-of-stream marker passed through the queues
+
+
+class StageTimer:
+    """Accumulate busy time and time spent waiting on the input / output queue of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.wait_input = 0.0
+        self.wait_output = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, busy=0.0, wait_input=0.0, wait_output=0.0, items=0):
+        with self._lock:
+            self.busy += busy
+            self.wait_input += wait_input
+            self.wait_output += wait_output
+            self.items += items
+
+    def get(self, q):
+        start = time.perf_counter()
+        item = q.get()
+        self.add(wait_input=time.perf_counter() - start)
+        return item
+
+    def put(self, q, item):
+        start = time.perf_counter()
+        q.put(item)
+        self.add(wait_output=time.perf_counter() - start)
+
+    def summary(self):
+        return {"stage": self.name, "items": self.items, "busy_s": round(self.busy, 3),
+                "wait_input_s": round(self.wait_input, 3), "wait_output_s": round(self.wait_output, 3)}
+
+
+def _decode_loop(names, decoded, image_dir, img_dim, decode_reduction, timer, errors):
+    # the end marker is always passed on, so the inference loop never waits on a decoder that died
+    try:
+        while True:
+            image_name = timer.get(names)
+            if image_name is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                with profiling.span("decode", image=image_name):
+                    img = split_predict.read_image(os.path.join(image_dir, image_name), decode_reduction)
+                if img is None:
+                    print("Not a valid path")
+                    print(f"Path: {os.path.join(image_dir, image_name)}")
+                    timer.add(busy=time.perf_counter() - start)
+                    continue
+                with profiling.span("tiling", image=image_name):
+                    tiles, offsets, img = split_predict.make_tiles(img, img_dim)
+            except Exception as e:
+                errors.append(("decode", image_name, e))
+                timer.add(busy=time.perf_counter() - start)
+                continue
+            timer.add(busy=time.perf_counter() - start, items=1)
+            timer.put(decoded, (image_name, img, tiles, offsets))
+    finally:
+        timer.put(decoded, _DONE)
+
+
+def _write_loop(written, output_path, img_dim, iou_thresh, conf_thresh, save_overlay, timer, errors):
+    while True:
+        item = timer.get(written)
+        if item is _DONE:
+            return
+        start = time.perf_counter()
+        try:
+            image_name, img, results, offsets = item
+            split_predict.write_detections(results, offsets, img, image_name, output_path, img_dim, iou_thresh, conf_thresh, save_overlay)
+        except Exception as e:
+            errors.append(("write", item[0], e))
+        timer.add(busy=time.perf_counter() - start, items=1)
+
+
+def run_pipeline(images_list, parent_directory, image_folder_dir, weight_path, output_dir, img_dim, iou_thresh, conf_thresh, batchsize,
+                 decode_reduction=1, save_overlay=True, decode_workers=2, writer_workers=2, queue_depth=4, backend="torch", int8=False,
+                 threads=None, resume=False):
+    """
+    Streaming decode -> tile -> infer -> write pipeline in a single process
+    Decode threads read and tile images into a bounded queue, the calling thread runs inference on full batches of
+    tiles taken across image boundaries, and writer threads run the cross-tile NMS and write the label file and the
+    annotated image. Peak memory is bounded by queue_depth, not by the number of images.
+    param decode_reduction: decode images at 1/decode_reduction resolution (1, 2, 4 or 8)
+    param save_overlay: write the annotated image next to the labels
+    param decode_workers: number of decode threads
+    param writer_workers: number of writer threads
+    param queue_depth: maximum number of images waiting between two stages
+    param backend: inference runtime (torch, onnx or openvino), see inference_backend
+    param int8: run the INT8 export of the weights (onnx / openvino)
+    param threads: intra-op threads of the runtime (None: runtime defaults)
+    param resume: skip images whose label file already exists in output_dir
+    return: list of per-stage timing summaries
+    """
+    weights = os.path.join(parent_directory, weight_path)
+    if threads is not None:
+        split_predict.init_worker(weights, backend, threads, int8)
+    model = split_predict.get_model(weights, backend, int8)
+    image_dir = os.path.join(parent_directory, image_folder_dir)
+    output_path = os.path.join(parent_directory, output_dir)
+    if resume:
+        images_list = [name for name in images_list if not os.path.exists(split_predict.label_path_of(output_path, name))]
+
+    decode_timer, infer_timer, write_timer = StageTimer("decode"), StageTimer("inference"), StageTimer("write")
+    names = queue.Queue()
+    decoded = queue.Queue(maxsize=queue_depth)
+    written = queue.Queue(maxsize=queue_depth)
+    errors = []
+
+    for image_name in images_list:
+        names.put(image_name)
+    for _ in range(decode_workers):
+        names.put(_DONE)
+
+    decoders = [threading.Thread(target=_decode_loop, args=(names, decoded, image_dir, img_dim, decode_reduction, decode_timer, errors), daemon=True)
+                for _ in range(decode_workers)]
+    writers = [threading.Thread(target=_write_loop, args=(written, output_path, img_dim, iou_thresh, conf_thresh, save_overlay, write_timer, errors), daemon=True)
+               for _ in range(writer_workers)]
+    for thread in decoders + writers:
+        thread.start()
+
+    pending = [] # [image_name, img, offsets, results] of images whose tiles are not all predicted yet
+    tiles = [] # (pending entry, tile) waiting for a batch
+    finished_decoders = 0
+
+    def run_batch(batch):
+        start = time.perf_counter()
+        results = split_predict.predict_tiles(model, [tile for _, tile in batch], img_dim, iou_thresh, conf_thresh, batchsize)
+        for (entry, _), result in zip(batch, results):
+            entry[3].append(result)
+        infer_timer.add(busy=time.perf_counter() - start)
+        # hand over completed images in arrival order
+        while pending and len(pending[0][3]) == len(pending[0][2]):
+            image_name, img, offsets, image_results = pending.pop(0)
+            infer_timer.add(items=1)
+            infer_timer.put(written, (image_name, img, image_results, offsets))
+
+    try:
+        while finished_decoders < decode_workers:
+            item = infer_timer.get(decoded)
+            if item is _DONE:
+                finished_decoders += 1
+                continue
+            image_name, img, image_tiles, offsets = item
+            entry = [image_name, img, offsets, []]
+            pending.append(entry)
+            tiles.extend((entry, tile) for tile in image_tiles)
+            while len(tiles) >= batchsize:
+                run_batch(tiles[:batchsize])
+                tiles = tiles[batchsize:]
+        if tiles:
+            run_batch(tiles)
+    finally:
+        if finished_decoders < decode_workers:
+            # inference failed: drop the images not decoded yet and drain the decoders so every thread can end
+            while True:
+                try:
+                    names.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in range(decode_workers):
+                names.put(_DONE)
+            while finished_decoders < decode_workers:
+                finished_decoders += decoded.get() is _DONE
+        for _ in range(writer_workers):
+            written.put(_DONE)
+        for thread in decoders + writers:
+            thread.join()
+
+    for stage, image_name, e in errors:
+        print(f"Failed to {stage} {image_name}: {e!r}")
+
+    return [timer.summary() for timer in (decode_timer, infer_timer, write_timer)]
+
+
+def print_stage_summary(summaries):
+    """Print how long each stage worked and how long it waited on its input and output queues."""
+    for s in summaries:
+        print(f"{s['stage']:>10}: {s['items']} images, busy {s['busy_s']} s, "
+              f"waiting for input {s['wait_input_s']} s, blocked on output {s['wait_output_s']} s")
@@ -1,85 +1,325 @@
-import os, numpy as np, cv2, ultralytics, re
-import nms_module
+import os, numpy as np, cv2, re
+import nms_module, inference_cache, detection_store, inference_backend, autotune, vegetation_filter, profiling
+from shapely import polygons
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 
-def divideImageImproved(image_name, parent_directory, image_folder_dir, weight_path, output_dir, img_dim, iou_thresh, conf_thresh, batchsize):
-    image_path = os.path.join(parent_directory, image_folder_dir, image_name)
-    model = ultralytics.YOLO(os.path.join(parent_directory, weight_path))
-    base = os.path.basename(image_path)
-    output_name = str(base).split(".")[0] + ".txt"
+# one model per process, loaded by init_worker (or lazily on first use)
+_model = None
+_model_key = None # (weight_path, backend, int8) of the loaded model
 
-    img = cv2.imread(image_path) # 3d array
-    if img is None:
-        print("Not a valid path")
-        print(f"Path: {image_path}")
-        return
-    
+
+def init_worker(weight_path, backend="torch", threads=None, int8=False):
+    """
+    Process-pool initializer: load the YOLO model once per worker process
+    param weight_path: path to the weight file
+    param backend: inference runtime, one of inference_backend.BACKENDS
+    param threads: intra-op threads of the runtime in this worker (None: runtime defaults)
+    param int8: use the INT8 export of the weights (onnx / openvino, exported beforehand)
+    """
+    global _model, _model_key
+    _model = inference_backend.load_model(weight_path, backend, threads=threads, int8=int8)
+    _model_key = (weight_path, backend, int8)
+
+
+def get_model(weight_path, backend="torch", int8=False):
+    """
+    Return the model of the current process, loading it only if the worker was not initialized with the same weights and backend
+    param weight_path: path to the weight file
+    return: ultralytics.YOLO model
+    """
+    if _model is None or _model_key != (weight_path, backend, int8):
+        init_worker(weight_path, backend, int8=int8)
+    return _model
+
+
+# cv2.imread flags for decoding at 1/1, 1/2, 1/4 and 1/8 of the full resolution
+DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def read_image(image_path, decode_reduction=1):
+    """
+    Decode an image, optionally at reduced resolution (JPEG DCT scaling, the full-size frame is never allocated)
+    param decode_reduction: 1, 2, 4 or 8, the image is decoded at 1/decode_reduction of its size
+    return: 3d array or None if the file cannot be read
+    """
+    if decode_reduction not in DECODE_FLAGS:
+        raise ValueError(f"decode_reduction must be one of {sorted(DECODE_FLAGS)}, got {decode_reduction}")
+    return cv2.imread(image_path, DECODE_FLAGS[decode_reduction])
+
+
+def make_tiles(img, img_dim):
+    """
+    Split an image into img_dim x img_dim tiles, in column-major order
+    Tiles overlap so the image is covered by a whole number of tiles, and every tile is a view into img (no copies).
+    When the last row / column of tiles runs past the image, those tiles are cut at the image border and the model
+    letterboxes them itself, so it sees the same pixels as with the original per-tile loop.
+    param img: decoded image (3d array)
+    param img_dim: tile side length in pixels
+    return: list of tile views, list of (start_x, start_y) offsets of each tile,
+            img itself (draw on this one after inference, it shares memory with the tiles)
+    """
     # y: vertical, x: horizontal
     y, x = img.shape[:2]
 
-    image_f = img.copy()
-
     num_cols = - (x // -img_dim)
-    x_overlap = img_dim - (x // num_cols)
-
     num_rows = - (y // -img_dim)
-    y_overlap = img_dim - (y // num_rows)
-    
-    tiles = []
-    offsets = []
+    step_x, step_y = x // num_cols, y // num_rows # img_dim - overlap
+
+    offsets = [(col * step_x, row * step_y) for col in range(num_cols) for row in range(num_rows)]
+    tiles = [img[start_y : start_y + img_dim, start_x : start_x + img_dim] for start_x, start_y in offsets]
+    return tiles, offsets, img
+
+
+def overlap_bands(length, img_dim):
+    """
+    Pixel intervals along one axis that are covered by two neighbouring tiles (same tile layout as make_tiles)
+    param length: image width or height in pixels
+    param img_dim: tile side length in pixels
+    return: list of (lo, hi) intervals
+    """
+    num_tiles = - (length // -img_dim)
+    step = length // num_tiles # distance between the top left corners of neighbouring tiles
+    return [((idx + 1) * step, idx * step + img_dim) for idx in range(num_tiles - 1)]
+
+
+def seam_nms(boxes, width, height, img_dim, conf_thresh, iou_thresh):
+    """
+    Cross-tile NMS restricted to the tile-overlap strips
+    Every tile was already suppressed by the model at iou_thresh, so duplicates can only come from two tiles that both
+    saw the same plant, i.e. boxes that touch an overlap band. Those boxes, plus the boxes close enough to overlap one
+    of them, go through nms_module.suppress; boxes inside a tile's exclusive interior are passed through.
+    param boxes: structured array with fields 'box' (global pixel corners) and 'conf'
+    return: kept rows of boxes in the same order as nms_module.nms
+    """
+    boxes = nms_module.sort_by_conf(boxes, conf_thresh)
+    pts = boxes['box']
+    keep = np.ones(len(boxes), dtype=bool)
+    if len(boxes) == 0:
+        return boxes
+
+    lo, hi = pts.min(axis=1), pts.max(axis=1)
+    # a box overlapping a seam box reaches at most one box span past the band
+    margin = (hi - lo).max(axis=0)
+    seam = np.zeros(len(boxes), dtype=bool)
+    for axis, length in ((0, width), (1, height)):
+        for band_lo, band_hi in overlap_bands(length, img_dim):
+            seam |= (hi[:, axis] >= band_lo - margin[axis]) & (lo[:, axis] <= band_hi + margin[axis])
+
+    keep[seam] = nms_module.suppress(polygons(pts[seam]), iou_thresh)
+    return boxes[keep]
+
+
+MAX_DET = 3000 # detections the model keeps per tile
+
+
+def predict_tiles(model, tiles, img_dim, iou_thresh, conf_thresh, batchsize, max_det=MAX_DET):
+    """
+    Run the model over a list of tiles in batches of exactly batchsize (the last batch may be partial)
+    return: list of ultralytics results, one per tile
+    """
+    results = []
+    for start in range(0, len(tiles), batchsize):
+        with profiling.span("inference", tiles=len(tiles[start : start + batchsize])):
+            results.extend(model.predict(source = tiles[start : start + batchsize], batch=batchsize, save=False, imgsz=img_dim, line_width=3,
+                                         show_labels=False, show_conf=False, max_det = max_det,
+                                         iou=iou_thresh, conf=conf_thresh, verbose=False))
+    return results
 
-    for i in range(0, x, img_dim):
-        for j in range(0, y, img_dim):
-            col_idx = i // img_dim
-            row_idx = j // img_dim
 
+# store global box coordinates, corresponding confidence scores and the tile each box came from
+BOX_DTYPE = np.dtype([('box', np.float32, (4, 2)), ('conf', np.float32), ('tile', np.int32)])
 
-            start_x = i - int(x_overlap * col_idx) # top left of current tile
-            start_y = j - int(y_overlap * row_idx) # top left of current tile
-            tile = img[start_y : start_y + img_dim, start_x : start_x + img_dim]
-            tiles.append(tile)
-            offsets.append((start_x, start_y)) 
+
+def raw_detections(results):
+    """
+    Tile-level model outputs as arrays
+    param results: ultralytics results, one per tile (None for tiles skipped by the vegetation filter)
+    return: (N,4,2) tile-local corners, (N,) confidences, (N,) index of the tile of each box
+    """
+    boxes, conf, tile = [np.zeros((0, 4, 2), np.float32)], [np.zeros(0, np.float32)], [np.zeros(0, np.int32)]
+    for idx, result in enumerate(results):
+        if result is not None and result.obb is not None and len(result.obb):
+            boxes.append(result.obb.xyxyxyxy.cpu().numpy().astype(np.float32))
+            conf.append(result.obb.conf.cpu().numpy().astype(np.float32))
+            tile.append(np.full(len(result.obb), idx, dtype=np.int32))
+    return np.concatenate(boxes), np.concatenate(conf), np.concatenate(tile)
+
+
+def global_boxes_from_raw(boxes, conf, tile, offsets):
+    """Shift tile-local boxes by their tile offsets into the structured array used by NMS."""
+    global_boxes = np.zeros(len(conf), dtype=BOX_DTYPE)
+    global_boxes['box'] = boxes + np.asarray(offsets, dtype=np.float32).reshape(-1, 2)[tile][:, None, :]
+    global_boxes['conf'] = conf
+    global_boxes['tile'] = tile
+    return global_boxes
+
+
+def replay_tile_nms(boxes, conf, tile, conf_thresh, iou_thresh):
+    """
+    Filter cached raw detections as the model would have at conf_thresh / iou_thresh: per tile, the confidence cut,
+    the model's rotated NMS and its MAX_DET cap (nms_module.model_nms)
+    param boxes: (N,4,2) tile-local corners of the raw candidates, conf: (N,), tile: (N,) tile index of each box
+    return: indices of the kept boxes, tile by tile
+    """
+    kept = [np.zeros(0, dtype=np.int64)]
+    candidates = np.flatnonzero(conf > conf_thresh)
+    for idx in np.unique(tile[candidates]):
+        in_tile = candidates[tile[candidates] == idx]
+        kept.append(in_tile[nms_module.model_nms(boxes[in_tile], conf[in_tile], iou_thresh)[:MAX_DET]])
+    return np.concatenate(kept)
+
+
+def write_detections(results, offsets, img, image_name, output_path, img_dim, iou_thresh, conf_thresh, save_overlay=True):
+    """
+    Merge tile results into global coordinates, run cross-tile NMS, write the normalized label file and the annotated image
+    param results: ultralytics results of the image's tiles (None for skipped tiles)
+    param offsets: (start_x, start_y) of each tile
+    param img: decoded image, boxes are drawn on it in place (its tiles must not be used afterwards)
+    param image_name: file name of the image
+    param output_path: output directory
+    param save_overlay: draw the kept boxes and write the annotated image
+    """
+    # map local coordinates to global: one (N,4,2) array shifted by the broadcast tile offsets
+    global_boxes = global_boxes_from_raw(*raw_detections(results), offsets)
+
+    with profiling.span("nms", image=image_name, boxes=len(global_boxes)):
+        kept = seam_nms(global_boxes, img.shape[1], img.shape[0], img_dim, conf_thresh, iou_thresh)
+    write_outputs(kept, img.shape[:2], img, image_name, output_path, save_overlay)
+
+
+def write_outputs(kept, shape, img, image_name, output_path, save_overlay=True):
+    """
+    Write the normalized label file, the image's part of the binary detection store and, optionally, the annotated image
+    param kept: kept rows (BOX_DTYPE) in global pixel coordinates
+    param shape: (height, width) of the decoded image
+    param img: decoded image to draw on in place, may be None when save_overlay is False
+    """
+    y, x = shape
+    output_name = str(image_name).split(".")[0] + ".txt"
+    label_path = os.path.join(output_path, output_name)
+
+    # write under a temporary name so an interrupted run never leaves a truncated label file behind
+    with profiling.span("label_write", image=image_name, boxes=len(kept)), open(label_path + ".tmp", "w") as f:
+        norm_boxes = kept['box'] / np.array([x, y], dtype=np.float32)
+        # float32 corners printed as Python floats, as when each corner was formatted on its own
+        values = iter(map(str, norm_boxes.ravel().tolist()))
+        f.write("".join("0 " + " ".join(row) + "\n" for row in zip(*[values] * 8)))
+
+    if save_overlay:
+        with profiling.span("overlay_write", image=image_name):
+            if len(kept):
+                cv2.polylines(img, np.int32(kept['box']), True, (0, 0, 255), 2)
+            cv2.imwrite(os.path.join(output_path, image_name), img)
+    with profiling.span("store_write", image=image_name):
+        detection_store.write_part(output_path, image_name, norm_boxes, kept['conf'], kept['tile'])
+    os.replace(label_path + ".tmp", label_path)
+
+
+def label_path_of(output_path, image_name):
+    return os.path.join(output_path, str(image_name).split(".")[0] + ".txt")
+
+
+def predictImageBatch(image_names, parent_directory, image_folder_dir, weight_path, output_dir, img_dim, iou_thresh, conf_thresh, batchsize,
+                      decode_reduction=1, save_overlay=True, cache_dir=None, resume=False, backend="torch", int8=False,
+                      min_vegetation=None):
+    """
+    Run tiled prediction over several images with one model
+    Tiles of all images are fed to the model as one stream, so batches are filled across image boundaries
+    and only the last batch of the whole call can be partial.
+    param image_names: list of image file names inside image_folder_dir
+    param decode_reduction: decode images at 1/decode_reduction resolution (1, 2, 4 or 8)
+    param save_overlay: write the annotated image next to the labels
+    param cache_dir: directory of the inference cache; with a cache the model runs once per image at the permissive
+                     inference_cache thresholds (every raw candidate), and conf_thresh / iou_thresh are applied afterwards
+                     by replaying the model's per-tile NMS and seam_nms, so re-runs with other thresholds need no inference
+    param resume: skip images whose label file already exists in output_dir
+    param backend: inference runtime (torch, onnx or openvino), see inference_backend
+    param int8: run the INT8 export of the weights (onnx / openvino)
+    param min_vegetation: skip tiles whose share of vegetation pixels (vegetation_filter) is below this value, None: run every tile
+    """
+    weights = os.path.join(parent_directory, weight_path)
+    output_path = os.path.join(parent_directory, output_dir)
+
+    images = [] # (image_name, img, offsets, cache key, mask of the tiles sent to the model)
+    cached = [] # (image_name, image_path, raw detections)
+    all_tiles = []
+    for image_name in image_names:
+        image_path = os.path.join(parent_directory, image_folder_dir, image_name)
+        if resume and os.path.exists(label_path_of(output_path, os.path.basename(image_path))):
+            continue
+        key = None
+        if cache_dir is not None and os.path.exists(image_path):
+            key = inference_cache.cache_key(image_path, weights, img_dim, decode_reduction, backend, int8, min_vegetation)
+            raw = inference_cache.load(cache_dir, key)
+            if raw is not None:
+                cached.append((os.path.basename(image_path), image_path, raw))
+                continue
+        with profiling.span("decode", image=image_name):
+            img = read_image(image_path, decode_reduction) # 3d array
+        if img is None:
+            print("Not a valid path")
+            print(f"Path: {image_path}")
+            continue
+        with profiling.span("tiling", image=image_name):
+            tiles, offsets, img = make_tiles(img, img_dim)
+        keep = np.ones(len(tiles), dtype=bool)
+        if min_vegetation is not None:
+            with profiling.span("vegetation_filter", image=image_name):
+                keep, scores = vegetation_filter.select_tiles(img, offsets, img_dim, min_vegetation)
+                vegetation_filter.write_stats(output_path, image_path, keep, scores, min_vegetation)
+        images.append((os.path.basename(image_path), img, offsets, key, keep))
+        all_tiles.extend(tile for tile, kept in zip(tiles, keep) if kept)
     # finished creating tiles and stored offset
 
     # run_prediction on tiles
-    results = model.predict(source = tiles, batch=batchsize, save=False, imgsz=img_dim, line_width=3, 
-                            show_labels=False, show_conf=False, max_det = 3000, 
-                            iou=iou_thresh, conf=conf_thresh)
-
-    with open(os.path.join(parent_directory, output_dir, output_name), "w") as f: 
-        detections = []
-        global_conf = []
-
-        for result, (start_x, start_y) in zip(results, offsets):
-            if result.obb is not None:
-                boxes = result.obb.xyxyxyxy.tolist() 
-                conf_scores = result.obb.conf.tolist()
-                for box, conf in zip(boxes, conf_scores):
-                    # map local coordinates to global
-                    global_box = [[pt[0] + start_x, pt[1] + start_y] for pt in box]
-                    # normalize
-                    # norm_box = [[pt[0] / x, pt[1] / y] for pt in global_box]
-                    detections.append(global_box)
-                    global_conf.append(conf)
-        
-        # perform nms
-        data_abstract = np.dtype([('box', np.float32, (4, 2)), ('conf', np.float32)]) # store global box coordinates and corresponding confidence scores
-        global_boxes = np.zeros(len(detections), dtype=data_abstract) # store global box coordinates and corresponding confidence scores
-        for i, (box, conf) in enumerate(zip(detections, global_conf)):
-            global_boxes[i] = (box, conf)
-        
-        nms_boxes = nms_module.nms(boxes=global_boxes, conf_threshold=conf_thresh, iou_threshold=iou_thresh)
-        for box in nms_boxes:
-            norm_box = [[pt[0] / x, pt[1] / y] for pt in box]
-            coords_str = " ".join([f"{pt[0]} {pt[1]}" for pt in norm_box])
-            f.write(f"0 {coords_str}\n")
-
-            # draw
-            pts = np.int32([box])
-            cv2.polylines(image_f, pts, True, (0, 0, 255), 2)
-    cv2.imwrite(os.path.join(parent_directory, output_dir, base), image_f)
+    results = []
+    if all_tiles:
+        model = get_model(weights, backend, int8)
+        if cache_dir is None:
+            results = predict_tiles(model, all_tiles, img_dim, iou_thresh, conf_thresh, batchsize)
+        else:
+            results = predict_tiles(model, all_tiles, img_dim, inference_cache.CACHE_IOU, inference_cache.CACHE_CONF, batchsize,
+                                    inference_cache.CACHE_MAX_DET)
+
+    start = 0
+    for image_name, img, offsets, key, keep in images:
+        predicted = iter(results[start : start + int(keep.sum())])
+        start += int(keep.sum())
+        image_results = [next(predicted) if kept else None for kept in keep]
+        if cache_dir is None:
+            write_detections(image_results, offsets, img, image_name, output_path, img_dim, iou_thresh, conf_thresh, save_overlay)
+        else:
+            with profiling.span("cache_write", image=image_name):
+                boxes, conf, tile = raw_detections(image_results)
+                inference_cache.save(cache_dir, key, boxes, conf, tile, offsets, img.shape[:2])
+            cached.append((image_name, None, {"boxes": boxes, "conf": conf, "tile": tile, "offsets": offsets, "shape": img.shape[:2], "img": img}))
+
+    # images with raw detections: the model's per-tile filtering and NMS are replayed, then the same seam NMS
+    for image_name, image_path, raw in cached:
+        shape = tuple(int(v) for v in raw["shape"]) # python ints, like img.shape, so label values print the same
+        with profiling.span("nms", image=image_name, boxes=len(raw["conf"])):
+            tile_kept = replay_tile_nms(raw["boxes"], raw["conf"], raw["tile"], conf_thresh, iou_thresh)
+            global_boxes = global_boxes_from_raw(raw["boxes"][tile_kept], raw["conf"][tile_kept], raw["tile"][tile_kept], raw["offsets"])
+            kept = seam_nms(global_boxes, shape[1], shape[0], img_dim, conf_thresh, iou_thresh)
+        img = raw.get("img")
+        if save_overlay and img is None:
+            with profiling.span("decode", image=image_name):
+                img = read_image(image_path, decode_reduction)
+        write_outputs(kept, shape, img, image_name, output_path, save_overlay and img is not None)
+
+
+def divideImageImproved(image_name, parent_directory, image_folder_dir, weight_path, output_dir, img_dim, iou_thresh, conf_thresh, batchsize,
+                        decode_reduction=1, save_overlay=True, cache_dir=None, resume=False, backend="torch", int8=False,
+                        min_vegetation=None):
+    predictImageBatch([image_name], parent_directory, image_folder_dir, weight_path, output_dir, img_dim, iou_thresh, conf_thresh, batchsize,
+                      decode_reduction, save_overlay, cache_dir, resume, backend, int8, min_vegetation)
+
+
+def chunk_list(items, size):
+    """Split a list into consecutive chunks of at most size items."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
 
 
 if __name__ == "__main__":
@@ -91,6 +331,21 @@ if __name__ == "__main__":
     parent_directory = "./"
     image_folder_dir = "DJI_202508081433_021_PineIslandbog5H3m5x3photo/"
     weight_path = "best.pt"
+    images_per_task = 4 # images whose tiles share batches in one worker call
+    pipeline_mode = False # stream decode / inference / write in one process instead of a process pool (no cache_dir / min_vegetation)
+    decode_reduction = 1 # 2 decodes at half resolution, for low-altitude flights where the GSD allows it
+    save_overlay = True # write annotated copies of the images next to the labels
+    cache_dir = None # e.g. "inference_cache/": raw tile detections, re-runs with other thresholds skip inference
+    resume_dir = None # output dir of an interrupted run to finish, images that already have labels are skipped
+    backend = "torch" # "onnx" / "openvino" export the weights once and run them on that CPU runtime
+    int8 = False # INT8 quantized export, calibrated on tiles of this flight (onnx / openvino)
+    # None: the value tuned on this machine (autotune), else the runtime defaults / one worker per core / 8
+    threads_per_worker = None # intra-op threads of each worker's runtime
+    workers = None # worker processes
+    batchsize = None
+    min_vegetation = None # e.g. vegetation_filter.MIN_VEGETATION skips tiles of open water / bare peat / sky (validate first)
+    profile_dir = None # e.g. "profile/": per-stage spans of every worker, merged into a Chrome trace and a JSON summary
+    autotune_mode = False # search worker / thread / batchsize settings on a few images first and keep the best for this machine
     
     # model = ultralytics.YOLO(os.path.join(parent_directory, weight_path))
     images = os.listdir(os.path.join(parent_directory, image_folder_dir))
@@ -113,10 +368,32 @@ if __name__ == "__main__":
                counter = max(counter, int(match.group(1) if match.group(1) != '' else 0)) + 1
                
     output_dir = f"output{counter}/" if counter > 1 else "output/"
+    if resume_dir is not None:
+        output_dir = resume_dir
+    if pipeline_mode:
+        # the pipeline runs inference in this process, without the inference cache or the vegetation filter
+        unsupported = [name for name, value in (("cache_dir", cache_dir), ("min_vegetation", min_vegetation), ("workers", workers))
+                       if value is not None]
+        if unsupported:
+            raise ValueError(f"pipeline_mode does not support {', '.join(unsupported)}, set them to None or use the process pool")
+    if backend != "torch":
+        # export once here, before tuning, the workers only load the cached artifact
+        inference_backend.export_model(os.path.join(parent_directory, weight_path), backend, img_dim=640, int8=int8,
+                                       calibration_images=[os.path.join(parent_directory, image_folder_dir, f) for f in images_list])
+    if autotune_mode:
+        autotune.tune_predict(images_list, parent_directory, image_folder_dir, weight_path, backend=backend, int8=int8)
+    tuned = autotune.load("predict")
+    if tuned is not None and not pipeline_mode and None in (workers, threads_per_worker, batchsize):
+        # settings calibrated for the process pool on this machine fill the ones left unset, explicit settings are kept
+        workers = tuned["workers"] if workers is None else workers
+        threads_per_worker = tuned["threads"] if threads_per_worker is None else threads_per_worker
+        batchsize = tuned["batchsize"] if batchsize is None else batchsize
+        print(f"Using tuned settings: {workers} workers, {threads_per_worker} threads each, batchsize {batchsize}")
+    batchsize = 8 if batchsize is None else batchsize
     print(f"Output will be saved in: {output_dir}\n")
-    os.mkdir(os.path.join(parent_directory, output_dir))
+    os.makedirs(os.path.join(parent_directory, output_dir), exist_ok=resume_dir is not None)
 
-    process = partial(divideImageImproved, 
+    process = partial(predictImageBatch,
                       parent_directory=parent_directory,
                       image_folder_dir=image_folder_dir,
                       weight_path=weight_path, 
@@ -124,8 +401,17 @@ if __name__ == "__main__":
                       img_dim=640, 
                       iou_thresh=0.5,
                       conf_thresh=0.35,
-                      batchsize=8)
+                      batchsize=batchsize,
+                      decode_reduction=decode_reduction,
+                      save_overlay=save_overlay,
+                      cache_dir=None if cache_dir is None else os.path.join(parent_directory, cache_dir),
+                      resume=resume_dir is not None,
+                      backend=backend,
+                      int8=int8,
+                      min_vegetation=min_vegetation)
 
+    if profile_dir is not None:
+        profiling.enable(os.path.join(parent_directory, profile_dir))
     print("executing...")
     # for img in images_list:
     #     divideImageImproved(image_name=img,
@@ -139,7 +425,24 @@ if __name__ == "__main__":
     #                         batchsize=8)
     
 
-    with ProcessPoolExecutor() as executor:
-        executor.map(process, images_list) 
+    if pipeline_mode:
+        # single process: decode threads -> batched inference -> writer threads
+        import split_pipeline
+        summaries = split_pipeline.run_pipeline(images_list, parent_directory, image_folder_dir, weight_path, output_dir,
+                                                img_dim=640, iou_thresh=0.5, conf_thresh=0.35, batchsize=batchsize,
+                                                decode_reduction=decode_reduction, save_overlay=save_overlay, backend=backend, int8=int8,
+                                                threads=threads_per_worker, resume=resume_dir is not None)
+        split_pipeline.print_stage_summary(summaries)
+    else:
+        # each worker loads the model once in its initializer and keeps it for every chunk it receives
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(os.path.join(parent_directory, weight_path), backend, threads_per_worker, int8)) as executor:
+            list(executor.map(process, chunk_list(images_list, images_per_task)))
 
+    # consolidate the per-image parts into the binary detection store of the flight
+    with profiling.span("store_build"):
+        detection_store.build_store(os.path.join(parent_directory, output_dir))
+    if min_vegetation is not None:
+        print(f"Vegetation filter: {vegetation_filter.summarize(os.path.join(parent_directory, output_dir))}")
+    if profile_dir is not None:
+        profiling.print_summary(profiling.merge(os.path.join(parent_directory, profile_dir)))
     print("Done!")
\ No newline at end of file
@@ -0,0 +1,145 @@
+import json, csv, numpy as np, cv2, shapely
+from dataclasses import dataclass
+import pixel_to_gps, profiling
+
+# spray zones: connected groups of grid cells above the density threshold, as simplified polygons in GPS
+# labelling, dilation and contour tracing run in OpenCV on the whole grid, polygons are built with vectorized shapely calls
+
+
+@dataclass
+class SprayZones:
+    """Spray zones of a density map, one entry per zone."""
+    polygons: np.ndarray # shapely polygons in (lon, lat), shift vector applied
+    area_m2: np.ndarray # area of each polygon in square meters
+    mean_density: np.ndarray # mean detections per square meter over the zone's grid cells
+    cells: np.ndarray # number of grid cells in the zone
+
+
+def zone_mask(density_map, threshold, boom_width_meters=None):
+    """
+    Cells above the threshold, optionally dilated by half the boom width on every side, with enclosed holes filled
+    return: (num_y_cells, num_x_cells) uint8 mask
+    """
+    density = density_map.counts / density_map.side_length_meters**2
+    mask = ((density > threshold) & density_map.filled).astype(np.uint8)
+    if boom_width_meters:
+        radius = int(np.ceil(boom_width_meters / 2 / density_map.side_length_meters))
+        mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1)))
+    # a sprayer flies over holes inside a zone, so each zone is its outer boundary
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(mask, contours, -1, 1, thickness=cv2.FILLED)
+    return mask, contours
+
+
+def zone_polygons(density_map, contours, tolerance_meters):
+    """
+    Simplified polygons in meters (origin frame) of traced zones, each covering every cell of its zone
+    param contours: outer contours of the zone mask (cell centers in (col, row))
+    return: shapely polygons, one per contour
+    """
+    # trace the zones again on the lattice of cell corners: a cell covers its 3 x 3 corner and edge points,
+    # so the contours run along the cell edges (cutting a corner of the empty cell at concave steps)
+    corners = np.zeros((2 * density_map.counts.shape[0] + 1, 2 * density_map.counts.shape[1] + 1), dtype=np.uint8)
+    zone_cells = np.zeros(density_map.counts.shape, dtype=np.uint8)
+    cv2.drawContours(zone_cells, contours, -1, 1, thickness=cv2.FILLED)
+    corners[1::2, 1::2] = zone_cells
+    corners = cv2.dilate(corners, np.ones((3, 3), dtype=np.uint8))
+    # one outline per contour, found through a cell center of the contour
+    outlines, _ = cv2.findContours(corners, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    owner = np.zeros(corners.shape, dtype=np.int32)
+    for i, outline in enumerate(outlines):
+        cv2.drawContours(owner, [outline], -1, i, thickness=cv2.FILLED)
+    rings = [outlines[owner[2 * int(c[0, 0, 1]) + 1, 2 * int(c[0, 0, 0]) + 1]].reshape(-1, 2) for c in contours]
+
+    # corner lattice -> meters in the origin frame, zones touching themselves at a corner are made valid
+    sizes = np.array([len(r) for r in rings])
+    ring = np.concatenate([np.vstack([r, r[:1]]) for r in rings]).astype(np.float64)
+    step_x, step_y = density_map.x_lines[1] - density_map.x_lines[0], density_map.y_lines[1] - density_map.y_lines[0]
+    ring = np.stack([density_map.x_lines[0] + ring[:, 0] / 2 * step_x, density_map.y_lines[0] + ring[:, 1] / 2 * step_y], axis=1)
+    exact = shapely.make_valid(shapely.polygons(shapely.linearrings(ring, indices=np.repeat(np.arange(len(rings)), sizes + 1))))
+    if not tolerance_meters:
+        return exact
+    # simplification cuts into boundary cells, growing the polygons by the tolerance (mitred, so no vertices are added)
+    # covers them again, and the union with the outline covers the few places where the simplified ring strays further
+    simplified = shapely.simplify(exact, tolerance_meters, preserve_topology=True)
+    return shapely.union(shapely.buffer(simplified, tolerance_meters, join_style="mitre"), exact)
+
+
+def extract_zones(density_map, threshold, origin_gps, yaw, shift_vector, boom_width_meters=None, tolerance_meters=None):
+    """
+    Threshold the density grid, label its connected cells and turn every zone into a simplified GPS polygon
+    param threshold: detections per square meter, as for the spray CSV
+    param yaw: yaw of the origin image (radians, mathematical angle)
+    param boom_width_meters: dilate the zones by half this width on every side, None: no dilation
+    param tolerance_meters: simplification tolerance (default: half a cell), the polygons grow by about this much
+                            so they still cover every zone cell
+    return: SprayZones
+    """
+    side = density_map.side_length_meters
+    tolerance_meters = side / 2 if tolerance_meters is None else tolerance_meters
+    with profiling.span("spray_zones", cells=density_map.density_grid.size):
+        mask, contours = zone_mask(density_map, threshold, boom_width_meters)
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if not contours:
+            return SprayZones(np.array([], dtype=object), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64))
+
+        # per-zone statistics over the labelled cells (label 0 is the background)
+        density = np.where(density_map.filled, density_map.counts / side**2, 0.0)
+        cells = stats[:, cv2.CC_STAT_AREA]
+        mean_density = np.bincount(labels.ravel(), weights=density.ravel(), minlength=count) / cells
+
+        meter_polygons = zone_polygons(density_map, contours, tolerance_meters)
+        zone = labels[[int(c[0, 0, 1]) for c in contours], [int(c[0, 0, 0]) for c in contours]]
+
+        def to_gps(xy):
+            lat, lon = pixel_to_gps.meters_to_gps(origin_gps[0], origin_gps[1], xy[:, 0], xy[:, 1], yaw)
+            return np.stack([lon + shift_vector[1], lat + shift_vector[0]], axis=1)
+
+        return SprayZones(polygons=shapely.transform(meter_polygons, to_gps), area_m2=shapely.area(meter_polygons),
+                          mean_density=mean_density[zone], cells=cells[zone])
+
+
+def write_geojson(zones, path):
+    """Write the zones as a GeoJSON FeatureCollection (WGS84 lon/lat) with area, mean density and cell count per zone."""
+    features = [{"type": "Feature", "geometry": json.loads(geometry),
+                 "properties": {"zone": i, "area_m2": float(area), "mean_density": float(mean), "cells": int(cells)}}
+                for i, (geometry, area, mean, cells) in enumerate(zip(shapely.to_geojson(zones.polygons), zones.area_m2, zones.mean_density, zones.cells))]
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def write_csv(zones, path):
+    """Write one row per zone: centroid, area, mean density and the polygon as WKT (lon lat)."""
+    centroids = shapely.get_coordinates(shapely.centroid(zones.polygons)).reshape(-1, 2)
+    with open(path, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["zone", "latitude", "longitude", "area_m2", "mean_density", "cells", "wkt"])
+        writer.writerows(zip(range(len(zones.cells)), centroids[:, 1], centroids[:, 0], zones.area_m2, zones.mean_density,
+                             zones.cells, shapely.to_wkt(zones.polygons, rounding_precision=-1)))
+
+
+if __name__ == "__main__":
+    import time, densitymap
+    rng = np.random.default_rng(0)
+    # coverage: every cell of a zone lies inside its simplified polygon, on random blobs and single cells
+    for side, tolerance in [(1.0, None), (0.5, None), (0.5, 2.0)]:
+        counts = (cv2.GaussianBlur(rng.uniform(0, 1, (120, 160)), (0, 0), 3) > 0.52) * 10 + (rng.uniform(0, 1, (120, 160)) > 0.995) * 10
+        density_map = densitymap.DensityMap(density_grid=(counts / side**2).astype(int), x_lines=np.arange(161) * side,
+                                            y_lines=np.arange(121) * side, chosen=np.zeros(counts.shape, dtype=int), counts=counts,
+                                            filled=np.ones(counts.shape, dtype=bool), side_length_meters=side, img_names=["a"], gps_map={})
+        mask, contours = zone_mask(density_map, threshold=1)
+        polygons = zone_polygons(density_map, contours, side / 2 if tolerance is None else tolerance)
+        rows, cols = np.nonzero(mask)
+        covered = shapely.covers(shapely.union_all(polygons), shapely.box(cols * side, rows * side, (cols + 1) * side, (rows + 1) * side))
+        exact = shapely.area(shapely.union_all(zone_polygons(density_map, contours, 0)))
+        print(f"side {side} m, tolerance {tolerance}: {len(contours)} zones, {int(covered.sum())} / {len(covered)} cells covered, "
+              f"area {shapely.area(shapely.union_all(polygons)) / exact:.2f}x the cells")
+
+    # benchmark
+    counts = (cv2.GaussianBlur(rng.uniform(0, 1, (1200, 1500)), (0, 0), 4) > 0.51) * 10
+    density_map = densitymap.DensityMap(density_grid=counts, x_lines=np.arange(1501.0), y_lines=np.arange(1201.0),
+                                        chosen=np.zeros(counts.shape, dtype=int), counts=counts, filled=np.ones(counts.shape, dtype=bool),
+                                        side_length_meters=1.0, img_names=["a"], gps_map={})
+    start = time.perf_counter()
+    zones = extract_zones(density_map, 1, (35.0, -78.0), 0.3, (0.0, 0.0))
+    print(f"{counts.size} cells: {len(zones.cells)} zones in {time.perf_counter() - start:.3f} s")
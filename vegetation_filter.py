@@ -0,0 +1,122 @@
+import os, json, numpy as np, cv2
+
+# excess green on chromatic coordinates, ExG = 2g - r - b with r = R / (R + G + B), ...
+# soil, peat and water score about 0, green foliage well above EXG_THRESHOLD
+EXG_THRESHOLD = 0.05 # pixel counts as vegetation above this ExG
+MIN_VEGETATION = 0.01 # default tile threshold: fraction of vegetation pixels below which a tile is skipped
+SUBSAMPLE = 4 # ExG is evaluated on every SUBSAMPLE-th pixel in both directions
+STATS_DIR = "vegetation_filter"
+
+
+def vegetation_mask(img, exg_threshold=EXG_THRESHOLD, subsample=SUBSAMPLE):
+    """
+    Vegetation pixels of a decoded BGR image, on a subsampled grid
+    return: uint8 (ceil(H/subsample), ceil(W/subsample)) mask, 1 for vegetation
+    """
+    small = img[::subsample, ::subsample].astype(np.float32)
+    b, g, r = small[..., 0], small[..., 1], small[..., 2]
+    total = b + g + r
+    exg = (2 * g - r - b) / np.maximum(total, 1)
+    return (exg > exg_threshold).astype(np.uint8)
+
+
+def tile_scores(img, offsets, img_dim, exg_threshold=EXG_THRESHOLD, subsample=SUBSAMPLE):
+    """
+    Fraction of vegetation pixels of every tile, from one mask and its integral image (tiles overlap, pixels are classified once)
+    Tile parts outside the image (edge tiles cut at the image border) count as non-vegetation.
+    param img: decoded image the tiles were cut from
+    param offsets: (start_x, start_y) of each tile, as returned by split_predict.make_tiles
+    return: (T,) float array of scores in [0, 1]
+    """
+    mask = vegetation_mask(img, exg_threshold, subsample)
+    integral = cv2.integral(mask) # (h+1, w+1), integral[y, x] = mask[:y, :x].sum()
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    h, w = mask.shape
+    x0 = np.minimum(-(-offsets[:, 0] // subsample), w)
+    y0 = np.minimum(-(-offsets[:, 1] // subsample), h)
+    x1 = np.minimum(-(-(offsets[:, 0] + img_dim) // subsample), w)
+    y1 = np.minimum(-(-(offsets[:, 1] + img_dim) // subsample), h)
+    counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return counts / (-(-img_dim // subsample)) ** 2
+
+
+def select_tiles(img, offsets, img_dim, min_vegetation=MIN_VEGETATION):
+    """
+    Tiles worth running the detector on
+    return: boolean keep mask over the tiles, tile scores
+    """
+    scores = tile_scores(img, offsets, img_dim)
+    return scores >= min_vegetation, scores
+
+
+def write_stats(output_path, image_name, keep, scores, min_vegetation):
+    """Record which tiles of an image were skipped, next to the labels (STATS_DIR/<image>.json)."""
+    path = os.path.join(output_path, STATS_DIR, os.path.basename(image_name).split(".")[0] + ".json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"image": os.path.basename(image_name), "min_vegetation": min_vegetation, "tiles": int(len(keep)),
+                   "skipped": int((~keep).sum()), "skipped_tiles": np.flatnonzero(~keep).tolist(),
+                   "scores": np.round(scores, 4).tolist()}, f)
+
+
+def summarize(output_path):
+    """
+    Totals over the per-image stats of a run, images served from the inference cache have no stats
+    return: dict with images, tiles and skipped tiles
+    """
+    stats_dir = os.path.join(output_path, STATS_DIR)
+    images, tiles, skipped = 0, 0, 0
+    for name in os.listdir(stats_dir) if os.path.isdir(stats_dir) else []:
+        with open(os.path.join(stats_dir, name)) as f:
+            stats = json.load(f)
+        images, tiles, skipped = images + 1, tiles + stats["tiles"], skipped + stats["skipped"]
+    return {"images": images, "tiles": tiles, "skipped": skipped, "skipped_share": skipped / max(tiles, 1)}
+
+
+def validate(image_dir, label_dir, img_dim, thresholds):
+    """
+    Recall loss and saved inference of every threshold on a labeled set
+    A ground-truth box is lost when no kept tile contains its center, so the loss is an upper bound of the
+    recall the detector could lose through the filter; the skipped share is the share of inference saved.
+    param label_dir: YOLO OBB ground truth (class x1 y1 ... x4 y4, normalized), one .txt per image
+    return: list of (threshold, skipped share, lost share of ground-truth boxes)
+    """
+    import split_predict
+    all_scores, box_scores = [], [] # per tile scores; per box, best score among the tiles that contain it
+    for name in sorted(os.listdir(image_dir)):
+        label_path = os.path.join(label_dir, os.path.splitext(name)[0] + ".txt")
+        if not os.path.exists(label_path):
+            continue
+        img = split_predict.read_image(os.path.join(image_dir, name))
+        if img is None:
+            continue
+        _, offsets, img = split_predict.make_tiles(img, img_dim)
+        scores = tile_scores(img, offsets, img_dim)
+        all_scores.append(scores)
+
+        labels = np.loadtxt(label_path, ndmin=2)
+        if len(labels) == 0:
+            continue
+        corners = labels[:, 1:9].reshape(-1, 4, 2) * [img.shape[1], img.shape[0]]
+        centers = corners.mean(axis=1)
+        offsets = np.asarray(offsets)
+        inside = ((centers[:, None, 0] >= offsets[None, :, 0]) & (centers[:, None, 0] < offsets[None, :, 0] + img_dim) &
+                  (centers[:, None, 1] >= offsets[None, :, 1]) & (centers[:, None, 1] < offsets[None, :, 1] + img_dim))
+        box_scores.append(np.where(inside, scores[None, :], -np.inf).max(axis=1))
+
+    scores = np.concatenate(all_scores) if all_scores else np.zeros(0)
+    best = np.concatenate(box_scores) if box_scores else np.zeros(0)
+    return [(t, float((scores < t).mean()) if len(scores) else 0.0, float((best < t).mean()) if len(best) else 0.0)
+            for t in thresholds]
+
+
+if __name__ == "__main__":
+    # validate the tile threshold on a labeled set: share of tiles skipped against share of ground-truth plants lost
+    image_dir = "validation/images/"
+    label_dir = "validation/labels/"
+    img_dim = 640
+    thresholds = [0.0, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+    print(f"{'threshold':>10} {'tiles skipped':>14} {'boxes lost':>11}")
+    for threshold, skipped, lost in validate(image_dir, label_dir, img_dim, thresholds):
+        print(f"{threshold:>10} {skipped:>14.1%} {lost:>11.2%}")